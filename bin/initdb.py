@@ -30,6 +30,7 @@ def init_db(config, engine=None):
         
     Base.metadata.drop_all(engine)
     Base.metadata.create_all(engine)
+    create_search_indexes(engine)
     
 def init_db_once(config):
     engine = get_engine(config)
@@ -39,6 +40,8 @@ def init_db_once(config):
 def update_metadata(config):
     engine = get_engine(config)
     Base.metadata.create_all(engine)
+    create_missing_indexes(engine)
+    create_search_indexes(engine)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,222 @@
+import json
+import time
+import uuid
+import hashlib
+import itertools
+import cherrypy
+import functools
+import threading
+from collections import OrderedDict
+from sqlalchemy import event
+from sqlalchemy.orm import object_mapper
+from mamabear.config import get_option
+from mamabear.metrics import metrics
+
+class ResponseCache(object):
+    """
+    In-process LRU cache of read endpoint responses, keyed by route
+    and parameters and bounded by entry count and encoded size.
+    Entries belong to the generation they were computed in; every
+    committed write in this process bumps the generation, which
+    invalidates them all at once. Writes made by other processes
+    (sharded workers, other web instances) aren't seen, so entries
+    also expire after `ttl` seconds.
+    """
+
+    def __init__(self, enabled=True, max_entries=1000, max_bytes=32*1024*1024, ttl=30, etags=True):
+        self.enabled = enabled
+        self.etags = etags
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.generation = 0
+        self.invalidated_at = 0
+        # Generations restart with the process, so they're only
+        # comparable alongside a per process nonce
+        self.nonce = uuid.uuid4().hex
+        self._entries = OrderedDict() # key -> (generation, expires, size, value)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def configure(self, config):
+        with self._lock:
+            self.enabled = get_option(config, 'cache', 'enabled', True)
+            self.max_entries = get_option(config, 'cache', 'max_entries', 1000)
+            self.max_bytes = get_option(config, 'cache', 'max_bytes', 32*1024*1024)
+            self.ttl = get_option(config, 'cache', 'ttl', 30)
+            self.etags = get_option(config, 'cache', 'etags', True)
+            self._clear()
+
+    def invalidate(self):
+        with self._lock:
+            self.generation += 1
+            self.invalidated_at = time.time()
+            self._clear()
+        metrics.incr('cache.invalidations')
+
+    def _clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+    def _pop(self, key):
+        generation, expires, size, value = self._entries.pop(key)
+        self._bytes -= size
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            generation, expires, size, value = entry
+            if generation != self.generation or expires <= time.time():
+                self._pop(key)
+                return None
+            # Most recently used entries live at the end
+            del self._entries[key]
+            self._entries[key] = entry
+            return value
+
+    def put(self, key, value, generation):
+        size = len(json.dumps(value))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            # A write committed while the response was computed, it may be stale
+            if generation != self.generation:
+                return
+            if key in self._entries:
+                self._pop(key)
+            self._entries[key] = (generation, time.time() + self.ttl, size, value)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._pop(next(iter(self._entries)))
+                metrics.incr('cache.evictions')
+
+    def etag(self, route, params):
+        """
+        Validator for a response, the same for as long as the
+        generation is and at most ttl seconds, like cached entries.
+        It's weak, since the gzipped and identity bodies share it.
+        """
+        window = int(time.time() // self.ttl) if self.ttl else 0
+        key = repr((self.nonce, self.generation, window, route, tuple(sorted(params.items()))))
+        return 'W/"{}"'.format(hashlib.md5(key.encode('utf-8')).hexdigest())
+
+    def size(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self._bytes}
+
+response_cache = ResponseCache()
+metrics.gauge('cache.entries', lambda: response_cache.size()['entries'])
+metrics.gauge('cache.bytes', lambda: response_cache.size()['bytes'])
+
+def invalidate():
+    response_cache.invalidate()
+
+# Worker bookkeeping that no cached response is built from
+UNSERVED_TABLES = set(['leases', 'worker_members', 'host_poll_schedules'])
+
+def mark_written(session):
+    """
+    Flag session as having written served data, for writes the
+    session events don't see, such as bulk mappings
+    """
+    session.info['cache_stale'] = True
+
+def invalidate_on_commit(session_factory):
+    """
+    Bump the cache generation whenever a session made by
+    session_factory commits a write to a table the cache serves
+    """
+    if not event.contains(session_factory, 'after_commit', _after_commit):
+        event.listen(session_factory, 'after_flush', _after_flush)
+        event.listen(session_factory, 'after_bulk_update', _after_bulk)
+        event.listen(session_factory, 'after_bulk_delete', _after_bulk)
+        event.listen(session_factory, 'after_rollback', _after_rollback)
+        event.listen(session_factory, 'after_commit', _after_commit)
+
+def _served(mapper):
+    return mapper.local_table.name not in UNSERVED_TABLES
+
+def _after_flush(session, flush_context):
+    for instance in itertools.chain(session.new, session.deleted):
+        if _served(object_mapper(instance)):
+            mark_written(session)
+            return
+    for instance in session.dirty:
+        if _served(object_mapper(instance)) and session.is_modified(instance):
+            mark_written(session)
+            return
+
+def _after_bulk(context):
+    if _served(context.mapper):
+        mark_written(context.session)
+
+def _after_rollback(session):
+    session.info.pop('cache_stale', None)
+
+def _after_commit(session):
+    if session.info.pop('cache_stale', False):
+        invalidate()
+
+def cached(handler):
+    """
+    Serve a GET handler's response from the response cache. Goes
+    under json_out, so the decoded response is cached, and only
+    successful responses are.
+    """
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        request = cherrypy.request
+        if request.method != 'GET' or not response_cache.enabled:
+            return handler(*args, **kwargs)
+
+        key = (request.path_info, tuple(sorted(request.params.items())))
+        value = response_cache.get(key)
+        if value is not None:
+            metrics.incr('cache.hits')
+            return value
+
+        metrics.incr('cache.misses')
+        generation = response_cache.generation
+        value = handler(*args, **kwargs)
+        if str(cherrypy.response.status or 200).startswith('200'):
+            response_cache.put(key, value, generation)
+        return value
+    return wrapper
+
+class ETagTool(cherrypy.Tool):
+    """
+    Conditional GETs for read endpoints. The ETag is derived from the
+    cache generation, route and parameters, so a matching If-None-Match
+    is answered with a 304 before the handler runs or anything is
+    encoded. Successful and 304 responses carry the ETag.
+    """
+
+    def __init__(self):
+        cherrypy.Tool.__init__(self, 'before_handler', self.check, priority=10)
+
+    def _setup(self):
+        cherrypy.Tool._setup(self)
+        cherrypy.request.hooks.attach('before_finalize', self.tag, priority=80)
+
+    def check(self):
+        request = cherrypy.request
+        if request.method not in ('GET', 'HEAD') or not response_cache.etags:
+            return
+        request.etag = response_cache.etag(request.path_info, request.params)
+        header = request.headers.get('If-None-Match')
+        if header:
+            # Weak comparison, as If-None-Match calls for
+            opaque = request.etag[2:]
+            tags = [t.strip() for t in header.split(',')]
+            if '*' in tags or any([(t[2:] if t.startswith('W/') else t) == opaque for t in tags]):
+                metrics.incr('cache.not_modified')
+                raise cherrypy.HTTPRedirect([], 304)
+
+    def tag(self):
+        etag = getattr(cherrypy.request, 'etag', None)
+        if etag and str(cherrypy.response.status or 200)[:3] in ('200', '304'):
+            cherrypy.response.headers['ETag'] = etag
+
+cherrypy.tools.etag = ETagTool()
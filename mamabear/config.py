@@ -0,0 +1,15 @@
+def get_option(config, section, option, default=None):
+    """
+    Read an optional setting from the config file, falling back
+    to the default when the section or option isn't configured.
+    The value is coerced to the type of the default.
+    """
+    if not config.has_option(section, option):
+        return default
+    if isinstance(default, bool):
+        return config.getboolean(section, option)
+    if isinstance(default, int):
+        return config.getint(section, option)
+    if isinstance(default, float):
+        return config.getfloat(section, option)
+    return config.get(section, option)
@@ -1,6 +1,71 @@
 
 import cherrypy
 from mamabear.model import *
+from mamabear.metrics import metrics
+from mamabear.cache import cached, invalidate
+from mamabear.plugin import primary
+
+def invalid_match(match):
+    cherrypy.response.status = 400
+    return {'error': 'unknown match mode {}, must be one of {}'.format(match, MATCH_MODES)}
+
+TOTAL_MODES = ['exact', 'approx', 'none']
+
+def positive_int(name, value):
+    """
+    Optional query parameter as an integer of at least 1, raising
+    ValueError when it's anything else
+    """
+    if value is None:
+        return None
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        number = 0
+    if number < 1:
+        raise ValueError("{} must be a positive integer, got {}".format(name, value))
+    return number
+
+def list_total(total, model, filtered, count):
+    """
+    Total for a list response: an exact count, the table statistics
+    estimate when the list is unfiltered and approx is asked for, or
+    no total at all
+    """
+    if total == 'none':
+        return None
+    if total == 'approx' and not filtered:
+        return approximate_count(cherrypy.request.db, model)
+    return count()
+
+def list_page(model, total, filters, list_kwargs, cursor):
+    """
+    Build a list response for model. With a cursor (empty for the
+    first page) the page is fetched by keyset and the response has
+    the cursor of the next page; otherwise limit/offset is used.
+    """
+    if total not in TOTAL_MODES:
+        cherrypy.response.status = 400
+        return {'error': 'unknown total mode {}, must be one of {}'.format(total, TOTAL_MODES)}
+    if filters.get('match') not in MATCH_MODES:
+        return invalid_match(filters.get('match'))
+
+    result = {}
+    db = cherrypy.request.db
+    try:
+        if cursor is not None:
+            list_kwargs = dict(list_kwargs)
+            list_kwargs.pop('offset', None)
+            result['hits'], result['next'] = model.list_page(db, cursor=cursor, **dict(filters, **list_kwargs))
+        else:
+            result['hits'] = model.list(db, **dict(filters, **list_kwargs))
+    except ValueError as e:
+        cherrypy.response.status = 400
+        return {'error': str(e)}
+
+    filtered = any([filters[k] for k in filters if k != 'match'])
+    result['total'] = list_total(total, model, filtered, lambda: model.count(db, **filters))
+    return result
 
 class HostController(object):
 
@@ -8,16 +73,23 @@ class HostController(object):
     # FIXME - need to do a full fledged list with filters and
     # sorting now that we have more fields.
     #
+    @cherrypy.tools.etag()
     @cherrypy.tools.json_out()
-    def list_hosts(self, hostname=None):
+    @cached
+    def list_hosts(self, hostname=None, fields=None, view='full'):
         if hostname:
             return {
                 'hits': [self.get_host(hostname=hostname)],
                 'total': 1
             }
-            
+
+        try:
+            hits = Host.list(cherrypy.request.db, fields=fields, view=view)
+        except ValueError as e:
+            cherrypy.response.status = 400
+            return {'error': str(e)}
         return {
-            'hits': Host.list(cherrypy.request.db),
+            'hits': hits,
             'total': Host.count(cherrypy.request.db)
         }
         
@@ -26,7 +98,7 @@ class HostController(object):
             cherrypy.response.status = 400
             return {"error":"no hostname specified"}
             
-        host = Host.get_by_name(cherrypy.request.db, hostname=hostname)
+        host = Host.get_by_name(cherrypy.request.db, hostname=hostname, eager=True)
         if host:
             return host.encode()
 
@@ -73,17 +145,28 @@ class HostController(object):
         
 class AppController(object):
 
+    @cherrypy.tools.etag()
     @cherrypy.tools.json_out()
-    def list_apps(self, name=None):
-        return {'hits': App.list(cherrypy.request.db, name=name),
-                'total': App.count(cherrypy.request.db, name=name)}        
+    @cached
+    def list_apps(self, name=None, match='contains', fields=None, view='full'):
+        if match not in MATCH_MODES:
+            return invalid_match(match)
+        try:
+            hits = App.list(cherrypy.request.db, name=name, match=match, fields=fields, view=view)
+        except ValueError as e:
+            cherrypy.response.status = 400
+            return {'error': str(e)}
+        return {'hits': hits,
+                'total': App.count(cherrypy.request.db, name=name, match=match)}
 
     @cherrypy.tools.json_out()
     def delete_app(self, name):
         deleted = App.delete(cherrypy.request.db, name)    
         return {"deleted":deleted, "name": name}
         
+    @cherrypy.tools.etag()
     @cherrypy.tools.json_out()
+    @cached
     def app_images(self, name):
         app = App.get(cherrypy.request.db, name)
         if app:
@@ -96,9 +179,11 @@ class AppController(object):
         cherrypy.response.status = 404
         return {"error":"app with name {0} not found".format(name)}
 
+    @cherrypy.tools.etag()
     @cherrypy.tools.json_out()
+    @cached
     def app_deployments(self, name):
-        app = App.get(cherrypy.request.db, name)
+        app = App.get(cherrypy.request.db, name, eager=True)
         if app:
             return {
                 name: {
@@ -110,6 +195,7 @@ class AppController(object):
         return {"error":"app with name {0} not found".format(name)}
 
     @cherrypy.tools.json_out()
+    @primary
     def refresh_images(self, name):
         app = App.get(cherrypy.request.db, name)
         try:
@@ -118,6 +204,8 @@ class AppController(object):
             cherrypy.log.error("Can't refresh images", traceback=True)
             cherrypy.response.status = 500
             return {'error': e.message} 
+        # A GET that writes, so the commit after the request won't invalidate
+        invalidate()
         return app.encode()    
 
 
@@ -183,22 +271,41 @@ class AppController(object):
 
 class DeploymentController(object):
 
+    @cherrypy.tools.etag()
     @cherrypy.tools.json_out()
+    @cached
     def get_deployment(self, app_name, image_tag, environment):
-        deployment = Deployment.get_by_app(cherrypy.request.db, app_name, image_tag=image_tag, environment=environment)
+        deployment = Deployment.get_by_app(cherrypy.request.db, app_name, image_tag=image_tag, environment=environment,
+                                           eager=True)
         if deployment:
             return deployment.encode()
         cherrypy.response.status = 404
         return {'error': 'deployment configuration ({}:{},{}) not found'.format(app_name, image_tag, environment)}
         
+    @cherrypy.tools.etag()
+    @cherrypy.tools.json_out()
+    @cached
+    def deployment_runs(self, app_name, image_tag, environment, limit=20):
+        deployment = Deployment.get_by_app(cherrypy.request.db, app_name, image_tag=image_tag, environment=environment)
+        if deployment:
+            return {
+                'runs': DeploymentRun.list(cherrypy.request.db, deployment.id, limit=int(limit)),
+                'phases': DeploymentRun.phase_stats(cherrypy.request.db, deployment.id)
+            }
+        cherrypy.response.status = 404
+        return {'error': 'deployment configuration ({}:{},{}) not found'.format(app_name, image_tag, environment)}
+
+    @cherrypy.tools.etag()
     @cherrypy.tools.json_out()
+    @cached
     def list_deployments(self, app_name=None, image_tag=None, environment=None,
-                         order='asc', sort_field='app_name', limit=10, offset=0):
-        return {
-            'hits': Deployment.list(cherrypy.request.db, app_name=app_name, image_tag=image_tag, environment=environment,
-                                    order=order, sort_field=sort_field, limit=limit, offset=offset),
-            'total': Deployment.count(cherrypy.request.db, app_name=app_name, image_tag=image_tag, environment=environment)
-        }
+                         order='asc', sort_field='app_name', limit=10, offset=0, match='contains',
+                         cursor=None, total='exact', fields=None, view='full'):
+        return list_page(
+            Deployment, total,
+            dict(app_name=app_name, image_tag=image_tag, environment=environment, match=match),
+            dict(order=order, sort_field=sort_field, limit=limit, offset=offset, fields=fields, view=view),
+            cursor)
 
     @cherrypy.tools.json_out()
     def delete_deployment(self, app_name, image_tag, environment):
@@ -206,10 +313,18 @@ class DeploymentController(object):
         return {'deleted': deleted, 'deployment':'{}:{}/{}'.format(app_name, image_tag, environment)}
         
     @cherrypy.tools.json_out()
-    def run_deployment(self, app_name, image_tag, environment):
+    @primary
+    def run_deployment(self, app_name, image_tag, environment, batch_size=None, max_unavailable=None):
+        try:
+            batch_size = positive_int('batch_size', batch_size)
+            max_unavailable = positive_int('max_unavailable', max_unavailable)
+        except ValueError as e:
+            cherrypy.response.status = 400
+            return {'error': str(e)}
+
         deployment = Deployment.get_by_app(cherrypy.request.db, app_name, image_tag=image_tag, environment=environment)
         if deployment:
-            self.worker.run_deployment(deployment.id)            
+            self.worker.run_deployment(deployment.id, batch_size=batch_size, max_unavailable=max_unavailable)
             return deployment.encode()
             
         cherrypy.response.status = 404
@@ -228,13 +343,16 @@ class DeploymentController(object):
         
 class ImageController(object):
 
+    @cherrypy.tools.etag()
     @cherrypy.tools.json_out()
-    def list_images(self, app_name=None, image_tag=None, order='asc', sort_field='app_name', limit=10, offset=0):
-        return {
-            'hits': Image.list(cherrypy.request.db, app_name=app_name, image_tag=image_tag, order=order,
-                               sort_field=sort_field, limit=limit, offset=offset),
-            'total': Image.count(cherrypy.request.db, app_name=app_name, image_tag=image_tag)
-        }
+    @cached
+    def list_images(self, app_name=None, image_tag=None, order='asc', sort_field='app_name', limit=10, offset=0,
+                    match='contains', cursor=None, total='exact'):
+        return list_page(
+            Image, total,
+            dict(app_name=app_name, image_tag=image_tag, match=match),
+            dict(order=order, sort_field=sort_field, limit=limit, offset=offset),
+            cursor)
 
 class ContainerController(object):
 
@@ -248,21 +366,31 @@ class ContainerController(object):
         cherrypy.response.status = 404
         return {'error': 'container with id: {} not found'.format(container_id)}
         
+    @cherrypy.tools.etag()
     @cherrypy.tools.json_out()
+    @cached
     def get_container(self, container_id):
-        container = Container.get(cherrypy.request.db, container_id)
+        container = Container.get(cherrypy.request.db, container_id, eager=True)
         if container:
             return container.encode()
         cherrypy.response.status = 404
         return {'error': 'container with id: {} not found'.format(container_id)}
     
+    @cherrypy.tools.etag()
     @cherrypy.tools.json_out()
+    @cached
     def list_containers(self, app_name=None, image_tag=None, host_name=None, status=None, container_state=None,
-                        command=None, order='desc', sort_field='started_at', limit=10, offset=0):
-        return {
-            'hits': Container.list(cherrypy.request.db, app_name=app_name, image_tag=image_tag, host_name=host_name,
-                                   status=status, container_state=container_state, command=command, order=order,
-                                   sort_field=sort_field, limit=limit, offset=offset),
-            'total': Container.count(cherrypy.request.db, app_name=app_name, image_tag=image_tag, host_name=host_name,
-                                     status=status, container_state=container_state, command=command)
-        }
+                        command=None, order='desc', sort_field='started_at', limit=10, offset=0, match='contains',
+                        cursor=None, total='exact'):
+        return list_page(
+            Container, total,
+            dict(app_name=app_name, image_tag=image_tag, host_name=host_name, status=status,
+                 container_state=container_state, command=command, match=match),
+            dict(order=order, sort_field=sort_field, limit=limit, offset=offset),
+            cursor)
+
+class MetricsController(object):
+
+    @cherrypy.tools.json_out()
+    def get_metrics(self):
+        return metrics.snapshot()
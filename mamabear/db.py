@@ -0,0 +1,153 @@
+import time
+import logging
+import itertools
+import threading
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import scoped_session, sessionmaker
+from mamabear.config import get_option
+from mamabear.metrics import metrics
+from mamabear.cache import invalidate_on_commit
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+logging.basicConfig(level=logging.INFO)
+
+def connection_string(config, section='mysql'):
+    """
+    Connection string for the database configured in section. Any
+    setting a replica section leaves out is taken from [mysql].
+    """
+    def option(name):
+        if config.has_option(section, name):
+            return config.get(section, name)
+        return config.get('mysql', name)
+    return 'mysql://%s:%s@%s/%s' % (
+        option('user'),
+        option('passwd'),
+        option('host'),
+        option('database')
+    )
+
+def _instrument_pool(engine, name):
+    """
+    Count connects and checkouts, time how long connections are
+    held, and expose the pool's current size as gauges
+    """
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        metrics.incr('db.{}.pool.connects'.format(name))
+
+    @event.listens_for(engine, 'checkout')
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        metrics.incr('db.{}.pool.checkouts'.format(name))
+        connection_record.info['checked_out_at'] = time.time()
+
+    @event.listens_for(engine, 'checkin')
+    def on_checkin(dbapi_connection, connection_record):
+        checked_out_at = connection_record.info.pop('checked_out_at', None)
+        if checked_out_at is not None:
+            metrics.observe('db.{}.pool.held'.format(name), time.time() - checked_out_at)
+
+    pool = engine.pool
+    metrics.gauge('db.{}.pool.size'.format(name), lambda: pool.size())
+    metrics.gauge('db.{}.pool.checked_out'.format(name), lambda: pool.checkedout())
+    metrics.gauge('db.{}.pool.overflow'.format(name), lambda: pool.overflow())
+
+def get_engine(config, section='mysql'):
+    """
+    Process wide engine for the database configured in section,
+    shared by the scheduler jobs, deploy threads and controllers.
+    Pool sizing, pre-ping and recycle come from the same section,
+    falling back to [mysql] like the connection settings.
+    """
+    def option(name, default):
+        return get_option(config, section, name, get_option(config, 'mysql', name, default))
+    url = connection_string(config, section)
+    with _engines_lock:
+        if url not in _engines:
+            engine = create_engine(
+                url, echo=False,
+                pool_size=option('pool_size', 10),
+                max_overflow=option('max_overflow', 10),
+                pool_recycle=option('pool_recycle', 3600),
+                pool_pre_ping=option('pool_pre_ping', True))
+            _instrument_pool(engine, section)
+            _engines[url] = engine
+        return _engines[url]
+
+_sessions = {}
+
+def get_session(engine):
+    """
+    Thread local session registry bound to engine. Threads share
+    the registry but each gets its own session, which it should
+    remove() once it's done with it. These are the worker's
+    sessions, so their commits invalidate the response cache when
+    they write data it serves.
+    """
+    with _engines_lock:
+        if engine not in _sessions:
+            factory = sessionmaker(autoflush=True, autocommit=False, bind=engine)
+            invalidate_on_commit(factory)
+            _sessions[engine] = scoped_session(factory)
+        return _sessions[engine]
+
+class ReplicaSet(object):
+    """
+    Read replicas of the primary database. check() is run every few
+    seconds and only keeps replicas that answer and are at most
+    max_lag seconds behind; pick() hands those out round robin, or
+    None when there are none, so the caller falls back to the primary.
+    """
+
+    def __init__(self, engines, max_lag=10):
+        self.engines = engines # section name -> engine
+        self.max_lag = max_lag
+        self.healthy = []
+        self._counter = itertools.count()
+
+    def lag(self, engine):
+        """
+        Seconds the replica is behind, None when it isn't replicating
+        """
+        row = engine.execute("SHOW SLAVE STATUS").first()
+        if row is not None:
+            return row['Seconds_Behind_Master']
+
+    def check(self):
+        healthy = []
+        for name in sorted(self.engines):
+            try:
+                lag = self.lag(self.engines[name])
+            except Exception as e:
+                logging.warn("Can't check replica {}, reason: [{}]".format(name, e))
+                lag = None
+            if lag is not None and lag <= self.max_lag:
+                healthy.append(self.engines[name])
+            else:
+                logging.warn("Replica {} is unavailable, lag: {}".format(name, lag))
+                metrics.incr('db.{}.unavailable'.format(name))
+        self.healthy = healthy
+
+    def pick(self):
+        healthy = self.healthy
+        if healthy:
+            return healthy[next(self._counter) % len(healthy)]
+
+    def dispose(self):
+        for engine in self.engines.values():
+            engine.dispose()
+
+def get_replicas(config):
+    """
+    Replica set for the sections listed in [mysql] replicas, or None
+    when there are no replicas configured
+    """
+    sections = [s.strip() for s in get_option(config, 'mysql', 'replicas', '').split(',') if s.strip()]
+    if not sections:
+        return None
+    replicas = ReplicaSet(dict([(section, get_engine(config, section)) for section in sections]),
+                          max_lag=get_option(config, 'mysql', 'replica_max_lag', 10))
+    metrics.gauge('db.replicas.healthy', lambda: len(replicas.healthy))
+    return replicas
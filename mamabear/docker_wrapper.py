@@ -1,44 +1,152 @@
+import json
 import time
 import docker
-import requests
 import logging
+import threading
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from mamabear.config import get_option
+from mamabear.health import HealthChecker
 
 logging.basicConfig(level=logging.INFO)
 
+class DockerClientPool(object):
+    """
+    Thread safe pool of docker clients keyed by (hostname, port), so
+    that requests to a host reuse warm TLS connections instead of
+    handshaking every time. At most `max_size` clients are handed
+    out per host at once, clients idle for more than `idle_timeout`
+    seconds are closed, and clients idle for more than
+    `validate_after` seconds are pinged before being reused.
+    """
+
+    def __init__(self, max_size=4, idle_timeout=300, validate_after=30):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.validate_after = validate_after
+        self._lock = threading.Lock()
+        self._idle = {}  # key -> [(client, last used)]
+        self._slots = {} # key -> semaphore bounding clients in use
+
+    def _close(self, client):
+        try:
+            client.close()
+        except Exception as e:
+            logging.warn("Failed to close docker client, reason: [{}]".format(e))
+
+    def _evict(self):
+        expired = []
+        now = time.time()
+        with self._lock:
+            for key in self._idle:
+                fresh = []
+                for client, last_used in self._idle[key]:
+                    if now - last_used > self.idle_timeout:
+                        expired.append(client)
+                    else:
+                        fresh.append((client, last_used))
+                self._idle[key] = fresh
+        for client in expired:
+            self._close(client)
+
+    def _checkout(self, key, factory):
+        self._evict()
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                if not idle:
+                    break
+                client, last_used = idle.pop()
+            if time.time() - last_used <= self.validate_after:
+                return client
+            try:
+                client.ping()
+                return client
+            except Exception as e:
+                logging.info("Dropping stale docker client for {}:{}, reason: [{}]".format(key[0], key[1], e))
+                self._close(client)
+        return factory()
+
+    def _checkin(self, key, client):
+        with self._lock:
+            self._idle.setdefault(key, []).append((client, time.time()))
+
+    @contextmanager
+    def client(self, key, factory):
+        """
+        Borrow a client for key, creating one with factory when
+        none is idle. Clients that fail below the API level are
+        closed rather than returned.
+        """
+        with self._lock:
+            slots = self._slots.setdefault(key, threading.BoundedSemaphore(self.max_size))
+        slots.acquire()
+        try:
+            client = self._checkout(key, factory)
+            try:
+                yield client
+            except docker.errors.APIError:
+                # The daemon answered, so the connection is still good
+                self._checkin(key, client)
+                raise
+            except Exception:
+                self._close(client)
+                raise
+            self._checkin(key, client)
+        finally:
+            slots.release()
+
 class DockerWrapper(object):
 
+    # Container fingerprints and details from the last sweep of
+    # each (host, port), shared by every wrapper in the process
+    _universe = {}
+    _universe_lock = threading.Lock()
+
+    # Pool of warm clients shared by every wrapper in the process
+    _pool = None
+    _pool_lock = threading.Lock()
+
     def __init__(self, docker_host, docker_port, config, retry=3):
         self.host = docker_host
         self.port = docker_port
         self.retry = retry # how many times to retry docker client requests
         self.registry_user = config.get('registry', 'user')
         self.registry_pass = config.get('registry', 'password')
-        
-        self._tls_conf = docker.tls.TLSConfig(
+        self._client_cert = (
+            config.get('docker', 'client_cert'),
+            config.get('docker', 'client_key')
+        )
+        self._pool = DockerWrapper.client_pool(config)
+        # (app name, phase, seconds) for every deploy phase completed
+        # through this wrapper
+        self.timings = []
+        # Seconds a started container gets to answer its status
+        # endpoint before the deploy fails, 0 to not wait at all
+        self.ready_timeout = get_option(config, 'deploy', 'ready_timeout', 120)
+        self._health = HealthChecker.shared(config)
+
+    @classmethod
+    def client_pool(cls, config):
+        with cls._pool_lock:
+            if cls._pool is None:
+                cls._pool = DockerClientPool(
+                    max_size=get_option(config, 'docker', 'pool_size', 4),
+                    idle_timeout=get_option(config, 'docker', 'pool_idle_timeout', 300),
+                    validate_after=get_option(config, 'docker', 'pool_validate_after', 30))
+            return cls._pool
+
+    def _new_client(self, timeout=10): # 10 second timeout
+        tls_conf = docker.tls.TLSConfig(
             assert_hostname=False,
             verify=False,
-            client_cert=(
-                config.get('docker', 'client_cert'),
-                config.get('docker', 'client_key')
-            ))
-        self._client = docker.Client(
-            base_url='https://%s:%s' % (docker_host, docker_port),
-            timeout=10, # 10 second timeout
-            tls=self._tls_conf
+            client_cert=self._client_cert)
+        return docker.Client(
+            base_url='https://%s:%s' % (self.host, self.port),
+            timeout=timeout,
+            tls=tls_conf
         )
 
-    @staticmethod
-    def list_images(registry_url, app_name, username, password=None):
-        url = "%s/repositories/%s/%s/tags" % (registry_url, username, app_name)
-        logging.info("Fetching url: {}".format(url))
-        if password:
-            r = requests.get(url, auth=(username, password))
-        else:
-            r = requests.get(url)
-        if r.ok:
-            return r.json()
-        r.raise_for_status()
-
     def _state_from_detail(self, s):
         if (s['Dead']):
             return 'dead'
@@ -51,38 +159,99 @@ class DockerWrapper(object):
         else:
             return 'stopped'
             
-    def state_of_the_universe(self):
+    def _container_data(self, info):
+        return self.container_state(info['Id'], image_ref=info['Image'])
+
+    def container_state(self, container_id, image_ref=None):
+        """
+        Cherry picked detail information for a single container
+        """
+        detail = self.inspect(container_id)
+        data = {
+            'id': container_id,
+            'image_id': detail['Image'],
+            'image_ref': image_ref or detail['Config']['Image'],
+            'state': self._state_from_detail(detail['State']),
+            'started_at': detail['State']['StartedAt'],
+            'finished_at': detail['State']['FinishedAt']
+        }
+        if detail['Config']['Cmd']:
+            data['command'] = ' '.join(detail['Config']['Cmd'])
+        return data
+
+    @staticmethod
+    def _fingerprint(info):
+        return (info['Id'], info.get('Status'), info.get('Created'))
+
+    def forget_universe(self):
+        """
+        Drop the fingerprints remembered for this host, so the next
+        incremental sweep inspects every container again
+        """
+        with DockerWrapper._universe_lock:
+            DockerWrapper._universe.pop((self.host, self.port), None)
+
+    def state_of_the_universe(self, incremental=False, threads=1):
         """
         High level function to list all containers,
-        and cherry picked detail information 
-        """
-        universe = []
-        for info in self.ps(all=True):
-            cid = info['Id']
-            detail = self.inspect(cid)
-            data = {
-                'id': cid,
-                'image_id': detail['Image'],
-                'image_ref': info['Image'],        
-                'state': self._state_from_detail(detail['State']),
-                'started_at': detail['State']['StartedAt'],
-                'finished_at': detail['State']['FinishedAt']
-            }
-            if detail['Config']['Cmd']:
-                data['command'] = ' '.join(detail['Config']['Cmd'])
-            universe.append(data)
-        return universe
+        and cherry picked detail information
+
+        In incremental mode only containers whose (Id, Status, Created)
+        fingerprint changed since the previous sweep of this host are
+        inspected; the rest reuse the details from that sweep. Inspects
+        are spread over up to `threads` threads.
+        """
+        key = (self.host, self.port)
+        previous = {}
+        if incremental:
+            with DockerWrapper._universe_lock:
+                previous = DockerWrapper._universe.get(key, {})
+
+        containers = self.ps(all=True)
+        known = {}
+        changed = []
+        for info in containers:
+            fingerprint = self._fingerprint(info)
+            if fingerprint in previous:
+                known[info['Id']] = previous[fingerprint]
+            else:
+                changed.append(info)
+
+        if changed and threads > 1:
+            pool = ThreadPool(min(threads, len(changed)))
+            try:
+                inspected = pool.map(self._container_data, changed)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            inspected = [self._container_data(info) for info in changed]
+
+        for data in inspected:
+            known[data['id']] = data
+
+        if incremental:
+            logging.info("Inspected {} of {} containers on {}".format(
+                len(changed), len(containers), self.host))
+            with DockerWrapper._universe_lock:
+                DockerWrapper._universe[key] = dict(
+                    [(self._fingerprint(info), known[info['Id']]) for info in containers])
+
+        return [known[info['Id']] for info in containers]
 
     def _client_request(self, method, *args, **kwargs):
         """
         Deal with the fact that the docker-py client has no
-        retry logic.
+        retry logic. A missing container or image is an answer,
+        not a failure, so it's raised without retrying.
         """
         last_exception = None
-        _method = getattr(self._client, method)
         for i in range(1, self.retry+1):
             try:
-                return _method(*args, **kwargs)
+                with self._pool.client((self.host, self.port), self._new_client) as client:
+                    return getattr(client, method)(*args, **kwargs)
+            except docker.errors.NotFound:
+                raise
             except Exception as e:
                 logging.warn("Failed to run client method: {}, reason: [{}]".format(method, e.message))
                 time.sleep(5)
@@ -100,9 +269,44 @@ class DockerWrapper(object):
         return self._client_request('logs', container_id, stderr=stderr,
                                     stdout=stdout, stream=stream, tail=tail)
 
+    def events(self, since, until):
+        """
+        Stream decoded docker events between since and until (unix
+        timestamps). The stream is served by a client of its own,
+        with a read timeout that outlasts the window, and isn't
+        retried: a broken stream is a disconnect for the caller.
+        The client is closed once the stream is done with.
+        """
+        client = self._new_client(timeout=max(until - time.time(), 0) + 10)
+        try:
+            for event in client.events(since=since, until=until, decode=True):
+                yield event
+        finally:
+            client.close()
+
     def pull(self, **kwargs):
         return self._client_request('pull', **kwargs)
 
+    def pull_image(self, app_name, image_tag):
+        """
+        Pull an app image from the registry. The daemon reports pull
+        failures inside the progress output rather than as an http
+        error, so the output is checked and failures raised.
+        """
+        with self._timed(app_name, 'pull'):
+            output = self.pull(
+                repository='{}/{}'.format(self.registry_user, app_name),
+                tag=image_tag,
+                auth_config={'username': self.registry_user, 'password': self.registry_pass}
+            )
+        for line in (output or '').splitlines():
+            try:
+                progress = json.loads(line)
+            except ValueError:
+                continue
+            if 'error' in progress:
+                raise docker.errors.DockerException(progress['error'])
+
     def rm(self, container_id):
         return self._client_request('remove_container', container_id)
 
@@ -115,31 +319,43 @@ class DockerWrapper(object):
     def start_container(self, container):
         return self._client_request('start', container=container.get('Id'))
 
-    def deploy_with_deps(self, tree):
-        deployment = tree['deployment']
-        dependencies = tree['dependencies']
-        for dependency in dependencies:
-            self.deploy_with_deps(dependency)
-
-        logging.info("Deploying {}:{}".format(
-            deployment.get('app_name'), deployment.get('image_tag')))
-        self.deploy(deployment)
-        
-    def run_with_deps(self, tree):
-        deployment = tree['deployment']
-        dependencies = tree['dependencies']
-        for dependency in dependencies:
-            self.run_with_deps(dependency)
+    def deploy_layers(self, layers, threads=4):
+        """
+        Deploy dependency layers in order, deploying the independent
+        deployments within a layer in parallel
+        """
+        for layer in layers:
+            for d in layer:
+                logging.info("Deploying {}:{}".format(d.get('app_name'), d.get('image_tag')))
+            if len(layer) == 1 or threads <= 1:
+                for d in layer:
+                    self.deploy(d)
+                continue
+            pool = ThreadPool(min(threads, len(layer)))
+            try:
+                pool.map(self.deploy, layer)
+            finally:
+                pool.close()
+                pool.join()
 
-        logging.info("Launching deployment {}:{}".format(
-            deployment.get('app_name'), deployment.get('image_tag')))
-        self.run(deployment)
+    @contextmanager
+    def _timed(self, app_name, phase):
+        # Failed phases are recorded too, flagged, they're the slow ones
+        started = time.time()
+        failed = True
+        try:
+            yield
+            failed = False
+        finally:
+            self.timings.append((app_name, phase, time.time() - started, failed))
 
     def deploy(self, d):
         app_name = d['app_name']
         try:
-            self.stop(app_name)
-            self.rm(app_name)
+            with self._timed(app_name, 'stop'):
+                self.stop(app_name)
+            with self._timed(app_name, 'rm'):
+                self.rm(app_name)
         except Exception as e:
             logging.warn(e)
         self.run(d)
@@ -195,17 +411,33 @@ class DockerWrapper(object):
         }
         
         try:
-            container = self._client_request('create_container', **kwargs)
-            self.start_container(container)
+            with self._timed(app_name, 'create'):
+                container = self._client_request('create_container', **kwargs)
+            with self._timed(app_name, 'start'):
+                self.start_container(container)
         except docker.errors.APIError as e:
             if e.message.response.status_code == 404:
                 logging.warn('container not found locally, pulling')
-                self.pull(
-                    repository='{}/{}'.format(self.registry_user, app_name),
-                    tag=image_tag,
-                    auth_config={'username': self.registry_user, 'password': self.registry_pass}
-                )
-                container = self.create_container(**kwargs)
-                self.start_container(container)
+                self.pull_image(app_name, image_tag)
+                with self._timed(app_name, 'create'):
+                    container = self.create_container(**kwargs)
+                with self._timed(app_name, 'start'):
+                    self.start_container(container)
             else:
                 raise e
+
+        if self.ready_timeout and d.get('status_port'):
+            self.wait_until_ready(app_name, status_url)
+
+    def wait_until_ready(self, app_name, status_url):
+        """
+        Block until a started app answers on its status url, so
+        anything depending on it only starts once it can serve
+        """
+        logging.info("Waiting up to {}s for {} to be ready at {}".format(
+            self.ready_timeout, app_name, status_url))
+        with self._timed(app_name, 'healthy'):
+            ready = self._health.wait_until_ready(status_url, self.ready_timeout)
+            if not ready:
+                raise docker.errors.DockerException("{} not ready at {} after {}s".format(
+                    app_name, status_url, self.ready_timeout))
@@ -0,0 +1,124 @@
+import time
+import logging
+import docker
+import threading
+from mamabear.model import *
+from mamabear.config import get_option
+from mamabear.docker_wrapper import DockerWrapper
+
+logging.basicConfig(level=logging.INFO)
+
+class HostEventSubscriber(threading.Thread):
+    """
+    Long running thread that follows the docker event stream of a
+    single host and applies container events to the db as they
+    happen. The stream is read in windows of `window` seconds, each
+    one picking up where the last left off, so a quiet host costs one
+    request per window. A full resync of the host's containers is only
+    done when the subscriber starts and after the stream breaks,
+    including when it ends cleanly before its window is up.
+    """
+
+    def __init__(self, worker, db, host_id, config):
+        threading.Thread.__init__(self, name='events-{}'.format(host_id))
+        self.daemon = True
+        self.worker = worker
+        self.db = db
+        self.host_id = host_id
+        self.config = config
+        self.window = get_option(config, 'worker', 'events_window', 60)
+        self.max_backoff = get_option(config, 'worker', 'events_max_backoff', 300)
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _resync(self, host):
+        logging.info("Resyncing containers for host: {}".format(host.hostname))
+        self.worker.update_host_containers(self.db, host, self.config)
+
+    def _follow(self, host):
+        wrapper = DockerWrapper(host.hostname, host.port, self.config)
+        since = int(time.time())
+        self._resync(host)
+        while not self._stopped.is_set():
+            until = since + self.window
+            for event in wrapper.events(since, until):
+                try:
+                    self.worker.apply_container_event(self.db, host, wrapper, event)
+                except Exception as e:
+                    logging.warn("Failed applying event {} on {}, reason: [{}]".format(
+                        event, host.hostname, e))
+                    self.db.rollback()
+            # The daemon closed the stream early, restarting say, and
+            # the events since then weren't seen
+            ended = time.time()
+            if ended < until - 1 and not self._stopped.is_set():
+                raise docker.errors.DockerException("event stream ended {:.0f}s early".format(
+                    until - ended))
+            since = until
+
+    def run(self):
+        backoff = 1
+        while not self._stopped.is_set():
+            hostname = self.host_id
+            try:
+                host = self.db.query(Host).get(self.host_id)
+                if not host:
+                    logging.info("Host {} is gone, stopping event subscriber".format(self.host_id))
+                    return
+                hostname = host.hostname
+                self._follow(host)
+            except Exception as e:
+                logging.warn("Lost event stream for host {}, reason: [{}], resyncing in {}s".format(
+                    hostname, e, backoff))
+                self.db.rollback()
+                self._stopped.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+            else:
+                backoff = 1
+            finally:
+                self.db.remove()
+
+class EventSubscribers(threading.Thread):
+    """
+    Keeps one HostEventSubscriber running for every configured
+    host, picking up hosts that are added or removed. Given a shard
+    membership, only the hosts owned by that shard are followed.
+    """
+
+    def __init__(self, worker, config, membership=None):
+        threading.Thread.__init__(self, name='events')
+        self.daemon = True
+        self.worker = worker
+        self.config = config
+        self.db = worker.get_session(worker.get_engine(config))
+        self.refresh_interval = get_option(config, 'worker', 'events_refresh', 60)
+        self.membership = membership
+        self.subscribers = {}
+
+    def refresh(self):
+        if self.membership:
+            host_ids = set(self.membership.owned_host_ids())
+        else:
+            host_ids = set([host_id for (host_id,) in self.db.query(Host.id).all()])
+        self.db.remove()
+
+        for host_id in set(self.subscribers) - host_ids:
+            self.subscribers.pop(host_id).stop()
+
+        for host_id in host_ids:
+            subscriber = self.subscribers.get(host_id)
+            if not subscriber or not subscriber.is_alive():
+                subscriber = HostEventSubscriber(self.worker, self.db, host_id, self.config)
+                subscriber.start()
+                self.subscribers[host_id] = subscriber
+
+    def run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                logging.error(e)
+                self.db.rollback()
+            time.sleep(self.refresh_interval)
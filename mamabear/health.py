@@ -0,0 +1,162 @@
+import time
+import random
+import logging
+import requests
+import threading
+from multiprocessing.pool import ThreadPool
+from requests.adapters import HTTPAdapter
+from mamabear.config import get_option
+
+logging.basicConfig(level=logging.INFO)
+
+class CircuitBreaker(object):
+    """
+    Per endpoint circuit breaker. After `threshold` consecutive
+    failures the circuit opens and the endpoint is reported down
+    without being probed, until `reset_timeout` seconds pass and a
+    single trial probe is let through.
+    """
+
+    def __init__(self, threshold=3, reset_timeout=60):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.time() - self.opened_at >= self.reset_timeout:
+                # Half open, let one probe through and wait for its result
+                self.opened_at = time.time()
+                return True
+            return False
+
+    def record(self, ok):
+        with self._lock:
+            if ok:
+                self.failures = 0
+                self.opened_at = None
+            else:
+                self.failures += 1
+                if self.failures >= self.threshold:
+                    self.opened_at = time.time()
+
+class HealthChecker(object):
+    """
+    Probes app status endpoints concurrently over a pooled,
+    keep-alive http session. Every probe has a hard deadline
+    covering all of its attempts, and endpoints that keep failing
+    are short circuited.
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, timeout=5, deadline=15, retry=3, threads=16,
+                 breaker_threshold=3, breaker_reset=60):
+        self.timeout = timeout
+        self.deadline = deadline
+        self.retry = retry
+        self.threads = threads
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+        self._breakers = {}
+        self._breakers_lock = threading.Lock()
+
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=threads, pool_maxsize=threads, max_retries=0)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+    @classmethod
+    def shared(cls, config):
+        """
+        Process wide checker, so connections and breaker state
+        outlive any single worker
+        """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls(
+                    timeout=get_option(config, 'health', 'timeout', 5),
+                    deadline=get_option(config, 'health', 'deadline', 15),
+                    retry=get_option(config, 'health', 'retry', 3),
+                    threads=get_option(config, 'health', 'threads', 16),
+                    breaker_threshold=get_option(config, 'health', 'breaker_threshold', 3),
+                    breaker_reset=get_option(config, 'health', 'breaker_reset', 60))
+            return cls._shared
+
+    def _breaker(self, url):
+        with self._breakers_lock:
+            if url not in self._breakers:
+                self._breakers[url] = CircuitBreaker(self.breaker_threshold, self.breaker_reset)
+            return self._breakers[url]
+
+    def _probe_once(self, url, timeout):
+        try:
+            return self._session.get(url, timeout=timeout).ok
+        except Exception as e:
+            logging.warn("Failed to check status of: {}, reason: [{}]".format(url, e))
+            return False
+
+    def _probe(self, url):
+        expires = time.time() + self.deadline
+        for attempt in range(1, self.retry+1):
+            remaining = expires - time.time()
+            if remaining <= 0:
+                break
+            if self._probe_once(url, min(self.timeout, remaining)):
+                return True
+        return False
+
+    def wait_until_ready(self, url, deadline, initial_delay=0.5, max_delay=10):
+        """
+        Poll url until it answers with a success status or the deadline
+        (in seconds) passes, backing off exponentially with jitter
+        between probes. The circuit breaker is bypassed, since a freshly
+        started app is expected to fail a few probes, but a success
+        closes it. Returns True once the app is ready.
+        """
+        expires = time.time() + deadline
+        delay = initial_delay
+        while True:
+            remaining = expires - time.time()
+            if remaining <= 0:
+                return False
+            if self._probe_once(url, min(self.timeout, remaining)):
+                self._breaker(url).record(True)
+                return True
+            remaining = expires - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(random.uniform(delay / 2.0, delay), remaining))
+            delay = min(delay * 2, max_delay)
+
+    def check(self, url):
+        """
+        Returns 'up' if the endpoint answered with a success status
+        within the deadline, 'down' otherwise
+        """
+        breaker = self._breaker(url)
+        if not breaker.allow():
+            logging.info("Circuit open for {}, reporting down".format(url))
+            return 'down'
+        ok = self._probe(url)
+        breaker.record(ok)
+        return 'up' if ok else 'down'
+
+    def check_all(self, urls):
+        """
+        Check every url at once, returning a map of url to status
+        """
+        urls = list(set(urls))
+        if not urls:
+            return {}
+        pool = ThreadPool(min(self.threads, len(urls)))
+        try:
+            return dict(zip(urls, pool.map(self.check, urls)))
+        finally:
+            pool.close()
+            pool.join()
@@ -0,0 +1,130 @@
+import os
+import time
+import uuid
+import socket
+import logging
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy.exc import IntegrityError
+from mamabear.model import *
+from mamabear.metrics import metrics
+
+logging.basicConfig(level=logging.INFO)
+
+def default_owner():
+    return '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+class LeaseLost(Exception):
+    """
+    Raised when work guarded by a lease finds the lease lost
+    """
+
+class DBLease(object):
+    """
+    Lease on a row of the leases table. Acquiring succeeds when the
+    lease is free, expired or already ours; while held, a heartbeat
+    thread pushes the expiry `ttl` seconds ahead every `heartbeat`
+    seconds, so a crashed holder only blocks others for one ttl.
+    Times are UTC, so holders need reasonably synced clocks.
+
+        with DBLease(db, 'sweep') as held:
+            if held:
+                ...
+                lease.check()
+                ...
+
+    Long running work should call check() between steps, to stop
+    once another holder may have taken the lease over.
+    """
+
+    def __init__(self, db, name, owner=None, ttl=120, heartbeat=30):
+        self.db = db
+        self.name = name
+        self.owner = owner or default_owner()
+        self.ttl = ttl
+        self.heartbeat = heartbeat
+        self.held = False
+        self.lost = False
+        self.renewed_at = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _extend(self, now, steal=False):
+        """
+        Move the expiry ahead if we own the lease, or if steal, take
+        it over when it has expired. Returns True if the lease is ours.
+        """
+        owned = Lease.owner == self.owner
+        if steal:
+            owned = or_(owned, Lease.expires_at < now)
+        values = {'owner': self.owner, 'heartbeat_at': now,
+                  'expires_at': now + timedelta(seconds=self.ttl)}
+        if steal:
+            values['acquired_at'] = now
+        updated = self.db.query(Lease).filter(Lease.name == self.name, owned).update(
+            values, synchronize_session=False)
+        self.db.commit()
+        return updated == 1
+
+    def acquire(self):
+        now = datetime.utcnow()
+        try:
+            if not self._extend(now, steal=True):
+                self.db.add(Lease(name=self.name, owner=self.owner, acquired_at=now, heartbeat_at=now,
+                                  expires_at=now + timedelta(seconds=self.ttl)))
+                self.db.commit()
+        except IntegrityError:
+            # Someone else holds it
+            self.db.rollback()
+            metrics.incr('lease.{}.contention'.format(self.name))
+            return False
+
+        self.held = True
+        self.renewed_at = time.time()
+        self._thread = threading.Thread(target=self._beat, name='lease-{}'.format(self.name))
+        self._thread.daemon = True
+        self._thread.start()
+        return True
+
+    def _beat(self):
+        while not self._stopped.wait(self.heartbeat):
+            try:
+                if not self._extend(datetime.utcnow()):
+                    logging.warn("Lost lease {}, owner {}".format(self.name, self.owner))
+                    metrics.incr('lease.{}.lost'.format(self.name))
+                    self.lost = True
+                    return
+                self.renewed_at = time.time()
+            except Exception as e:
+                logging.warn("Failed to heartbeat lease {}, reason: [{}]".format(self.name, e))
+                self.db.rollback()
+            finally:
+                self.db.remove()
+
+    def check(self):
+        """
+        Raise LeaseLost if the lease was taken over, or if heartbeats
+        have failed for long enough that it may have expired
+        """
+        if self.lost or (self.renewed_at is not None and time.time() - self.renewed_at >= self.ttl):
+            raise LeaseLost("Lease {} lost by {}".format(self.name, self.owner))
+
+    def release(self):
+        if not self.held:
+            return
+        self._stopped.set()
+        self._thread.join()
+        try:
+            self.db.query(Lease).filter(Lease.name == self.name, Lease.owner == self.owner).update(
+                {'expires_at': datetime.utcnow()}, synchronize_session=False)
+            self.db.commit()
+        except Exception as e:
+            logging.warn("Failed to release lease {}, reason: [{}]".format(self.name, e))
+            self.db.rollback()
+        self.held = False
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc_info):
+        self.release()
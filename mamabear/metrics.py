@@ -0,0 +1,51 @@
+import threading
+
+class Metrics(object):
+    """
+    Process wide counters, timings and gauges, exposed through
+    the metrics endpoint
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._timings = {} # name -> [count, total, max]
+        self._gauges = {}  # name -> callable returning the current value
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        with self._lock:
+            timing = self._timings.setdefault(name, [0, 0.0, 0.0])
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2], seconds)
+
+    def gauge(self, name, fn):
+        with self._lock:
+            self._gauges[name] = fn
+
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self._counters)
+            timings = dict([(name, list(timing)) for name, timing in self._timings.items()])
+            gauges = dict(self._gauges)
+
+        result = {'counters': counters, 'timings': {}, 'gauges': {}}
+        for name, (count, total, slowest) in timings.items():
+            result['timings'][name] = {
+                'count': count,
+                'total': round(total, 4),
+                'mean': round(total / count, 4) if count else 0,
+                'max': round(slowest, 4)
+            }
+        for name, fn in gauges.items():
+            try:
+                result['gauges'][name] = fn()
+            except Exception:
+                result['gauges'][name] = None
+        return result
+
+metrics = Metrics()
@@ -1,12 +1,228 @@
+import json
+import math
+import base64
+import logging
 import traceback
+from datetime import datetime
 from sqlalchemy.sql.expression import func
-from sqlalchemy.orm import relationship, backref, load_only
+from sqlalchemy.orm import relationship, backref, load_only, selectinload, joinedload, defaultload, Load
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import ForeignKey, ForeignKeyConstraint, Table
-from sqlalchemy import asc, desc, or_, and_, not_, CHAR, TIMESTAMP, Text, DateTime, Column, BigInteger, Integer, String
+from sqlalchemy import ForeignKey, ForeignKeyConstraint, Table, inspect
+from sqlalchemy import asc, desc, or_, and_, not_, case, CHAR, TIMESTAMP, Text, DateTime, Column, BigInteger, Integer, String, Float, Boolean
 
 Base = declarative_base()
 
+# How list filters match their terms: anywhere in the column,
+# at its start, or the whole value. Prefix and exact matches can
+# use the column's b-tree index.
+MATCH_MODES = ['contains', 'prefix', 'exact']
+
+# Columns searched through an ngram FULLTEXT index in contains mode,
+# by index name. Terms shorter than the ngram size can't use them.
+SEARCH_INDEXES = {
+    'ft_hosts_hostname': ('hosts', 'hostname'),
+    'ft_images_app_name': ('images', 'app_name'),
+    'ft_images_tag': ('images', 'tag'),
+    'ft_containers_command': ('containers', 'command'),
+    'ft_apps_name': ('apps', 'name'),
+    'ft_deployments_app_name': ('deployments', 'app_name'),
+    'ft_deployments_image_tag': ('deployments', 'image_tag'),
+}
+NGRAM_TOKEN_SIZE = 2
+
+CURSOR_TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+# How list endpoints encode their hits: the full nested encoding,
+# or a few columns plus aggregate counts of the related rows
+VIEWS = ['full', 'summary']
+
+# (table, column) pairs whose search index exists in the database
+_fulltext_columns = set()
+
+def create_search_indexes(engine):
+    """
+    Add the ngram FULLTEXT search indexes that don't exist yet. The
+    stopword list is switched off for the session, since the ngram
+    parser drops every token containing a stopword.
+    """
+    if engine.dialect.name != 'mysql':
+        return
+    existing = set([name for (name, _) in _search_index_rows(engine)])
+    with engine.connect() as conn:
+        conn.execute("SET SESSION innodb_ft_enable_stopword = OFF")
+        for name in sorted(SEARCH_INDEXES):
+            if name not in existing:
+                table, column = SEARCH_INDEXES[name]
+                conn.execute("ALTER TABLE {} ADD FULLTEXT INDEX {} ({}) WITH PARSER ngram".format(
+                    table, name, column))
+    detect_search_indexes(engine)
+
+def create_missing_indexes(engine):
+    """
+    Add the model's b-tree indexes that existing tables don't have
+    yet, since create_all only indexes the tables it creates
+    """
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    for table in Base.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = set([index['name'] for index in inspector.get_indexes(table.name)])
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            if index.name not in existing:
+                logging.info("Adding index {} to {}".format(index.name, table.name))
+                index.create(engine)
+
+def detect_search_indexes(engine):
+    """
+    Find which search indexes exist, so that contains filters only
+    use MATCH on columns that can serve it
+    """
+    _fulltext_columns.clear()
+    if engine.dialect.name != 'mysql':
+        return
+    for name, _ in _search_index_rows(engine):
+        if name in SEARCH_INDEXES:
+            _fulltext_columns.add(SEARCH_INDEXES[name])
+
+def _search_index_rows(engine):
+    return engine.execute(
+        "SELECT DISTINCT INDEX_NAME, TABLE_NAME FROM information_schema.STATISTICS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND INDEX_TYPE = 'FULLTEXT'").fetchall()
+
+def _escape_like(term):
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def _text_filter(column, term, match='contains'):
+    """
+    Filter clause matching term against column in the given mode.
+    Contains filters on indexed columns narrow the rows with the
+    FULLTEXT index, and the LIKE keeps the match exact.
+    """
+    if match == 'exact':
+        return column == term
+    if match == 'prefix':
+        return column.like(_escape_like(term) + '%', escape='\\')
+    clause = column.like('%' + _escape_like(term) + '%', escape='\\')
+    phrase = term.replace('"', '')
+    mapped = column.property.columns[0]
+    if (mapped.table.name, mapped.name) in _fulltext_columns and len(phrase) >= NGRAM_TOKEN_SIZE:
+        clause = and_(column.match('"' + phrase + '"'), clause)
+    return clause
+
+def _encode_cursor(value, row_id):
+    if isinstance(value, datetime):
+        value = value.strftime(CURSOR_TIME_FORMAT)
+    return base64.urlsafe_b64encode(json.dumps([value, row_id]).encode('utf-8')).decode('ascii')
+
+def _decode_cursor(column, cursor):
+    try:
+        value, row_id = json.loads(base64.urlsafe_b64decode(str(cursor)).decode('utf-8'))
+        if value is not None and isinstance(column.property.columns[0].type, DateTime):
+            value = datetime.strptime(value, CURSOR_TIME_FORMAT)
+        return value, row_id
+    except (TypeError, ValueError):
+        raise ValueError("invalid cursor {}".format(cursor))
+
+def _keyset_page(q, model, sort_field, order, limit, cursor=None):
+    """
+    Order q by sort_field then id, and return one page of rows plus
+    the cursor of the next page (None on the last page). A cursor
+    from the previous page makes the query continue right after it
+    on the (sort_field, id) index, instead of skipping rows with an
+    offset. NULLs sort first ascending and last descending, as MySQL
+    orders them.
+    """
+    column = getattr(model, sort_field)
+    limit = int(limit)
+    if cursor:
+        value, last_id = _decode_cursor(column, cursor)
+        if order == 'asc':
+            if value is None:
+                q = q.filter(or_(and_(column == None, model.id > last_id), column != None))
+            else:
+                q = q.filter(or_(column > value, and_(column == value, model.id > last_id)))
+        else:
+            if value is None:
+                q = q.filter(and_(column == None, model.id < last_id))
+            else:
+                q = q.filter(or_(column < value, and_(column == value, model.id < last_id), column == None))
+
+    direction = asc if order == 'asc' else desc
+    rows = q.order_by(direction(column), direction(model.id)).limit(limit + 1).all()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, _encode_cursor(getattr(rows[-1], sort_field), rows[-1].id)
+    return rows, None
+
+def approximate_count(session, model):
+    """
+    Row count estimate for model's table from the table statistics,
+    free of the full scan an exact count needs
+    """
+    row = session.execute(
+        "SELECT TABLE_ROWS FROM information_schema.TABLES "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :name",
+        {'name': model.__tablename__}).fetchone()
+    if row:
+        return row[0]
+
+def parse_fields(model, fields=None, view='full'):
+    """
+    Column names of model to encode for a comma separated fields
+    list and a view, or None for the full encoding. Raises ValueError
+    for an unknown view or field.
+    """
+    if view not in VIEWS:
+        raise ValueError("unknown view {}, must be one of {}".format(view, VIEWS))
+    if fields:
+        names = [f.strip() for f in fields.split(',') if f.strip()]
+        unknown = [f for f in names if f not in model.__table__.columns]
+        if unknown:
+            raise ValueError("unknown fields {}, must be among {}".format(
+                unknown, sorted(model.__table__.columns.keys())))
+        return names
+    if view == 'summary':
+        return list(model.SUMMARY_FIELDS)
+
+def _project(q, model, fields, *extra):
+    """
+    Restrict q to the named columns of model (and its primary key),
+    leaving every relationship unloaded
+    """
+    return q.options(load_only(*[getattr(model, f) for f in set(fields) | set(extra)]))
+
+def _encode_projection(session, model, rows, fields, view):
+    hits = []
+    for row in rows:
+        encoded = {}
+        for f in fields:
+            value = getattr(row, f)
+            if isinstance(value, datetime):
+                value = value.strftime('%Y-%m-%d %H:%M:%S')
+            encoded[f] = value
+        hits.append(encoded)
+    if view == 'summary':
+        key = model.__mapper__.primary_key[0].key
+        counts = model.summary_counts(session, [getattr(row, key) for row in rows])
+        for row, encoded in zip(rows, hits):
+            encoded.update(counts[getattr(row, key)])
+    return hits
+
+def _grouped_counts(q, keys):
+    """
+    Run a (key, count) query grouped by key, for the given keys only,
+    as a map with a zero for keys without rows
+    """
+    counts = dict([(k, 0) for k in keys])
+    if keys:
+        for key, count in q.all():
+            counts[key] = int(count or 0)
+    return counts
+
+def _up(status_column):
+    return func.sum(case([(status_column == 'up', 1)], else_=0))
+
 class Host(Base):
     __tablename__ = "hosts"
     id = Column(Integer, autoincrement=True, primary_key=True)
@@ -16,8 +232,10 @@ class Host(Base):
     status = Column(String(4), index=True)
     asg_name = Column(String(200), ForeignKey("aws_asgs.group_name"), index=True)
     containers = relationship("Container", backref="host")
+    poll_schedule = relationship("HostPollSchedule", uselist=False, cascade="all, delete-orphan")
 
     VALID_STATUS = ['up', 'down']
+    SUMMARY_FIELDS = ['hostname', 'alias', 'port', 'status', 'asg_name']
 
     @staticmethod
     def delete_by_alias(session, alias):
@@ -53,9 +271,11 @@ class Host(Base):
             return host
                 
     @staticmethod
-    def get_by_name(session, hostname):
+    def get_by_name(session, hostname, eager=False):
         h = session.query(Host).filter(Host.hostname == hostname).limit(1)
         if h.count() == 1:
+            if eager:
+                h = h.options(*Host.encode_options())
             return h.one()
 
     @staticmethod    
@@ -69,9 +289,36 @@ class Host(Base):
         return q.count()
 
     @staticmethod
-    def list(session):
+    def list(session, fields=None, view='full'):
+        fields = parse_fields(Host, fields, view)
         q = Host.list_query(session)
+        if fields is not None:
+            return _encode_projection(session, Host, _project(q, Host, fields).all(), fields, view)
+        q = q.options(*Host.encode_options())
         return [h.encode() for h in q.all()]
+
+    @staticmethod
+    def summary_counts(session, host_ids):
+        """
+        Container count and up container count of each host
+        """
+        containers = _grouped_counts(session.query(Container.host_id, func.count(Container.id)).filter(
+            Container.host_id.in_(host_ids)).group_by(Container.host_id), host_ids)
+        up = _grouped_counts(session.query(Container.host_id, _up(Container.status)).filter(
+            Container.host_id.in_(host_ids)).group_by(Container.host_id), host_ids)
+        return dict([(i, {'container_count': containers[i], 'up_containers': up[i]}) for i in host_ids])
+
+    @staticmethod
+    def encode_options():
+        """
+        Load strategies for what encode touches: the containers in
+        one extra query, and what each container encodes with them
+        """
+        containers = selectinload(Host.containers)
+        return [
+            containers.joinedload(Container.deployment),
+            containers.joinedload(Container.image)
+        ]
     
     def encode(self):
         encoded = {
@@ -115,23 +362,23 @@ class Image(Base):
             return q.limit(1).one()
             
     @staticmethod    
-    def list_query(session, app_name=None, image_tag=None):
+    def list_query(session, app_name=None, image_tag=None, match='contains'):
         q = session.query(Image)
         if app_name:
-            q = q.filter(Image.app_name.like('%'+app_name+'%'))
+            q = q.filter(_text_filter(Image.app_name, app_name, match))
         if image_tag:
-            q = q.filter(Image.tag.like('%'+image_tag+'%'))
+            q = q.filter(_text_filter(Image.tag, image_tag, match))
         return q
 
     @staticmethod
-    def count(session, app_name=None, image_tag=None):
-        q = Image.list_query(session, app_name=app_name, image_tag=image_tag)
+    def count(session, app_name=None, image_tag=None, match='contains'):
+        q = Image.list_query(session, app_name=app_name, image_tag=image_tag, match=match)
         return q.count()
 
     @staticmethod
     def list(session, app_name=None, image_tag=None, order='asc',
-             sort_field='app_name', limit=10, offset=0):
-        q = Image.list_query(session, app_name=app_name, image_tag=image_tag)
+             sort_field='app_name', limit=10, offset=0, match='contains'):
+        q = Image.list_query(session, app_name=app_name, image_tag=image_tag, match=match)
 
         if order == 'asc':
             q = q.order_by(asc(getattr(Image, sort_field)))
@@ -142,6 +389,13 @@ class Image(Base):
 
         return [r.encode() for r in q.all()]
 
+    @staticmethod
+    def list_page(session, app_name=None, image_tag=None, order='asc',
+                  sort_field='app_name', limit=10, cursor=None, match='contains'):
+        q = Image.list_query(session, app_name=app_name, image_tag=image_tag, match=match)
+        rows, next_cursor = _keyset_page(q, Image, sort_field, order, limit, cursor)
+        return [r.encode() for r in rows], next_cursor
+
     def encode(self):
         return {
             'app_name': self.app_name,
@@ -159,7 +413,7 @@ class Container(Base):
     status = Column(String(4), index=True)
 
     # This is container status itself
-    started_at = Column(DateTime)
+    started_at = Column(DateTime, index=True)
     finished_at = Column(DateTime)
     state = Column(String(12), index=True)
                    
@@ -175,37 +429,41 @@ class Container(Base):
     
     @staticmethod    
     def list_query(session, app_name=None, image_tag=None, host_name=None,
-                   status=None, container_state=None, command=None):
+                   status=None, container_state=None, command=None, match='contains'):
         q = session.query(Container)
+        if app_name or image_tag:
+            q = q.join(Container.image)
         if app_name:            
-            q = q.join(Container.image).filter(Image.app_name.like('%'+app_name+'%'))
+            q = q.filter(_text_filter(Image.app_name, app_name, match))
         if image_tag:
-            q = q.join(Container.image).filter(Image.tag.like('%'+image_tag+'%'))
+            q = q.filter(_text_filter(Image.tag, image_tag, match))
         if host_name:
-            q = q.join(Container.host).filter(Host.hostname.like('%'+host_name+'%'))
+            q = q.join(Container.host).filter(_text_filter(Host.hostname, host_name, match))
         if status:
             q = q.filter(Container.status == status)
         if container_state:
             q = q.filter(Container.state == container_state)
         if command:
-            q = q.filter(Container.command.like('%'+command+'%'))
+            q = q.filter(_text_filter(Container.command, command, match))
         return q
 
     @staticmethod
     def count(session, app_name=None, image_tag=None, host_name=None,
-              status=None, container_state=None, command=None):
+              status=None, container_state=None, command=None, match='contains'):
         q = Container.list_query(session, app_name=app_name, image_tag=image_tag,
                                  host_name=host_name, status=status,
-                                 container_state=container_state, command=command)
+                                 container_state=container_state, command=command,
+                                 match=match)
         return q.count()
 
     @staticmethod
     def list(session, app_name=None, image_tag=None, host_name=None,
              status=None, container_state=None, command=None, order='asc',
-             sort_field='started_at', limit=10, offset=0):
+             sort_field='started_at', limit=10, offset=0, match='contains'):
         q = Container.list_query(session, app_name=app_name, image_tag=image_tag,
                                  host_name=host_name, status=status,
-                                 container_state=container_state, command=command)
+                                 container_state=container_state, command=command,
+                                 match=match).options(*Container.encode_options())
         if order == 'asc':
             q = q.order_by(asc(getattr(Container, sort_field)))
         else:
@@ -214,14 +472,40 @@ class Container(Base):
         q = q.limit(limit).offset(offset)
 
         return [r.encode() for r in q.all()]
+
+    @staticmethod
+    def list_page(session, app_name=None, image_tag=None, host_name=None,
+                  status=None, container_state=None, command=None, order='asc',
+                  sort_field='started_at', limit=10, cursor=None, match='contains'):
+        q = Container.list_query(session, app_name=app_name, image_tag=image_tag,
+                                 host_name=host_name, status=status,
+                                 container_state=container_state, command=command,
+                                 match=match).options(*Container.encode_options())
+        rows, next_cursor = _keyset_page(q, Container, sort_field, order, limit, cursor)
+        return [r.encode() for r in rows], next_cursor
         
     @staticmethod
     def get_by_ref(session, image_ref):
         return session.query(Container).filter(Container.image_ref == image_ref).all()
         
     @staticmethod
-    def get(session, container_id):
-        return session.query(Container).get(container_id)
+    def get(session, container_id, eager=False):
+        q = session.query(Container)
+        if eager:
+            q = q.options(*Container.encode_options())
+        return q.get(container_id)
+
+    @staticmethod
+    def encode_options():
+        """
+        Load strategies for what encode touches, all many to one, so
+        they are joined into the same query
+        """
+        return [
+            joinedload(Container.host),
+            joinedload(Container.deployment),
+            joinedload(Container.image)
+        ]
         
     def encode(self):
         result = {
@@ -249,6 +533,8 @@ class App(Base):
     deployments = relationship("Deployment", backref="app")
     images = relationship("Image", backref="app")
 
+    SUMMARY_FIELDS = ['name']
+
     @staticmethod
     def delete(session, name):
         app = App.get(session, name)
@@ -275,26 +561,62 @@ class App(Base):
             return app
             
     @staticmethod
-    def get(session, name):
-        return session.query(App).get(name)
+    def get(session, name, eager=False):
+        q = session.query(App)
+        if eager:
+            q = q.options(*App.encode_options())
+        return q.get(name)
         
     @staticmethod    
-    def list_query(session, name=None):
+    def list_query(session, name=None, match='contains'):
         q = session.query(App)
         if name:
-            q = q.filter(App.name.like('%'+name+'%'))
+            q = q.filter(_text_filter(App.name, name, match))
         return q
 
     @staticmethod
-    def count(session, name=None):
-        q = App.list_query(session, name)
+    def count(session, name=None, match='contains'):
+        q = App.list_query(session, name, match=match)
         return q.count()
 
     @staticmethod
-    def list(session, name=None):
-        q = App.list_query(session, name)
+    def list(session, name=None, match='contains', fields=None, view='full'):
+        fields = parse_fields(App, fields, view)
+        q = App.list_query(session, name, match=match)
+        if fields is not None:
+            return _encode_projection(session, App, _project(q, App, fields).all(), fields, view)
+        q = q.options(*App.encode_options())
         return [a.encode() for a in q.all()]
 
+    @staticmethod
+    def summary_counts(session, names):
+        """
+        Image, deployment and up container counts of each app
+        """
+        images = _grouped_counts(session.query(Image.app_name, func.count(Image.id)).filter(
+            Image.app_name.in_(names)).group_by(Image.app_name), names)
+        deployments = _grouped_counts(session.query(Deployment.app_name, func.count(Deployment.id)).filter(
+            Deployment.app_name.in_(names)).group_by(Deployment.app_name), names)
+        up = _grouped_counts(session.query(Deployment.app_name, _up(Container.status)).join(
+            Container, Container.deployment_id == Deployment.id).filter(
+            Deployment.app_name.in_(names)).group_by(Deployment.app_name), names)
+        return dict([(n, {
+            'image_count': images[n],
+            'deployment_count': deployments[n],
+            'up_containers': up[n]
+        }) for n in names])
+
+    @staticmethod
+    def encode_options():
+        """
+        Load strategies for what encode touches: images and
+        deployments, each deployment loaded the way it encodes
+        """
+        return [
+            selectinload(App.images),
+            selectinload(App.deployments)
+        ] + Deployment.encode_options(defaultload(App.deployments))
+
     def encode(self):
         return {
             'name': self.name,
@@ -302,6 +624,11 @@ class App(Base):
             'deployments': [d.encode() for d in self.deployments]
         }
         
+class DependencyCycleError(Exception):
+    """
+    Raised when deployments link to each other in a cycle
+    """
+
 deployment_hosts = Table(
     'deployment_hosts', Base.metadata,
     Column('host_id', Integer, ForeignKey("hosts.id")),
@@ -335,11 +662,13 @@ class Deployment(Base):
     env_vars = relationship("EnvironmentVariable", foreign_keys="EnvironmentVariable.id", cascade="all, delete-orphan")
     hosts = relationship("Host", secondary=deployment_hosts, backref="deployments")
     containers = relationship("Container", backref="deployment")
+    runs = relationship("DeploymentRun", backref="deployment", cascade="all, delete-orphan")
     
     links = relationship("Image", secondary=deployment_links)
     volumes = relationship("Image", secondary=deployment_volumes)
     
     required_keys = ['image_tag', 'app_name', 'environment']
+    SUMMARY_FIELDS = ['id', 'app_name', 'image_tag', 'environment']
 
     def name(self):
         return "%s:%s, %s" % (self.app_name, self.image_tag, self.environment)
@@ -444,25 +773,29 @@ class Deployment(Base):
         return False
         
     @staticmethod    
-    def list_query(session, app_name=None, image_tag=None, environment=None):
+    def list_query(session, app_name=None, image_tag=None, environment=None, match='contains'):
         q = session.query(Deployment)
         if app_name:
-            q = q.filter(Deployment.app_name.like('%'+app_name+'%'))
+            q = q.filter(_text_filter(Deployment.app_name, app_name, match))
         if image_tag:
-            q = q.filter(Deployment.image_tag.like('%'+image_tag+'%'))
+            q = q.filter(_text_filter(Deployment.image_tag, image_tag, match))
         if environment:
-            q = q.filter(Deployment.environment.like('%'+environment+'%'))            
+            q = q.filter(_text_filter(Deployment.environment, environment, match))
         return q
 
     @staticmethod
-    def count(session, app_name=None, image_tag=None, environment=None):
-        q = Deployment.list_query(session, app_name=app_name, image_tag=image_tag, environment=environment)
+    def count(session, app_name=None, image_tag=None, environment=None, match='contains'):
+        q = Deployment.list_query(session, app_name=app_name, image_tag=image_tag,
+                                  environment=environment, match=match)
         return q.count()
 
     @staticmethod
     def list(session, app_name=None, image_tag=None, environment=None,
-             order='asc', sort_field='app_name', limit=10, offset=0):
-        q = Deployment.list_query(session, app_name=app_name, image_tag=image_tag, environment=environment)
+             order='asc', sort_field='app_name', limit=10, offset=0, match='contains',
+             fields=None, view='full'):
+        fields = parse_fields(Deployment, fields, view)
+        q = Deployment.list_query(session, app_name=app_name, image_tag=image_tag,
+                                  environment=environment, match=match)
 
         if order == 'asc':
             q = q.order_by(asc(getattr(Deployment, sort_field)))
@@ -471,10 +804,42 @@ class Deployment(Base):
             
         q = q.limit(limit).offset(offset)
 
+        if fields is not None:
+            return _encode_projection(session, Deployment, _project(q, Deployment, fields).all(), fields, view)
+        q = q.options(*Deployment.encode_options())
         return [r.encode() for r in q.all()]
+
+    @staticmethod
+    def list_page(session, app_name=None, image_tag=None, environment=None,
+                  order='asc', sort_field='app_name', limit=10, cursor=None, match='contains',
+                  fields=None, view='full'):
+        fields = parse_fields(Deployment, fields, view)
+        q = Deployment.list_query(session, app_name=app_name, image_tag=image_tag,
+                                  environment=environment, match=match)
+        if fields is not None:
+            # The sort field is loaded too, the next cursor is built from it
+            q = _project(q, Deployment, fields, sort_field)
+            rows, next_cursor = _keyset_page(q, Deployment, sort_field, order, limit, cursor)
+            return _encode_projection(session, Deployment, rows, fields, view), next_cursor
+        q = q.options(*Deployment.encode_options())
+        rows, next_cursor = _keyset_page(q, Deployment, sort_field, order, limit, cursor)
+        return [r.encode() for r in rows], next_cursor
+
+    @staticmethod
+    def summary_counts(session, deployment_ids):
+        """
+        Host count and up container count of each deployment
+        """
+        hosts = _grouped_counts(session.query(
+            deployment_hosts.c.deployment_id, func.count(deployment_hosts.c.host_id)).filter(
+            deployment_hosts.c.deployment_id.in_(deployment_ids)).group_by(
+            deployment_hosts.c.deployment_id), deployment_ids)
+        up = _grouped_counts(session.query(Container.deployment_id, _up(Container.status)).filter(
+            Container.deployment_id.in_(deployment_ids)).group_by(Container.deployment_id), deployment_ids)
+        return dict([(i, {'host_count': hosts[i], 'up_containers': up[i]}) for i in deployment_ids])
         
     @staticmethod
-    def get_by_app(session, app_name, image_tag=None, environment=None):
+    def get_by_app(session, app_name, image_tag=None, environment=None, eager=False):
         q = session.query(Deployment).filter(Deployment.app_name == app_name)
         if image_tag:
             q = q.filter(Deployment.image_tag == image_tag)
@@ -482,19 +847,74 @@ class Deployment(Base):
             q = q.filter(Deployment.environment == environment)
         q = q.limit(1)
         if q.count() == 1:
+            if eager:
+                q = q.options(*Deployment.encode_options())
             return q.one()
 
-    def encode_with_deps(self, session):
-        result = {'deployment': self.encode(), 'dependencies':[]}
-        children = dict([(image.id, image) for image in self.links+self.volumes])
-        for child_id in children:
-            child = children[child_id]
-            child_deployment = Deployment.get_by_app(
-                session, child.app_name, child.tag, self.environment)
-            if child_deployment:
-                result['dependencies'].append(child_deployment.encode_with_deps(session))
-        return result
-            
+    @staticmethod
+    def encode_options(path=None):
+        """
+        Load strategies for what encode touches, every collection
+        in one extra query. Given a loader path, the options are
+        relative to it, for deployments loaded through a relationship.
+        """
+        path = path if path is not None else Load(Deployment)
+        containers = path.selectinload(Deployment.containers)
+        return [
+            path.selectinload(Deployment.hosts),
+            path.selectinload(Deployment.links),
+            path.selectinload(Deployment.volumes),
+            path.selectinload(Deployment.env_vars),
+            containers.joinedload(Container.host),
+            containers.joinedload(Container.image)
+        ]
+
+    def dependency_layers(self, session):
+        """
+        Resolve this deployment and everything it links to or takes
+        volumes from into a deduplicated dependency graph. Every
+        deployment in the environment is loaded up front, with its
+        links and volumes, in one batched query. Returns the encoded
+        deployments in topological layers, dependencies first, where
+        the deployments within a layer don't depend on each other.
+        """
+        candidates = session.query(Deployment).filter(
+            Deployment.environment == self.environment
+        ).options(
+            selectinload(Deployment.links), selectinload(Deployment.volumes)
+        ).order_by(Deployment.id).all()
+
+        by_app = {}
+        for candidate in candidates:
+            by_app.setdefault((candidate.app_name, candidate.image_tag), candidate)
+
+        nodes = {}
+        dependencies = {}
+        def visit(deployment, path):
+            if deployment.id in path:
+                cycle = path[path.index(deployment.id):] + [deployment.id]
+                raise DependencyCycleError(' -> '.join([nodes[i].name() for i in cycle]))
+            if deployment.id in dependencies:
+                return
+            nodes[deployment.id] = deployment
+            children = set()
+            for image in deployment.links + deployment.volumes:
+                child = by_app.get((image.app_name, image.tag))
+                if child:
+                    visit(child, path + [deployment.id])
+                    children.add(child.id)
+            dependencies[deployment.id] = children
+
+        visit(self, [])
+
+        layers = []
+        done = set()
+        while len(done) < len(nodes):
+            layer = sorted([i for i in nodes if i not in done and dependencies[i] <= done])
+            layers.append([nodes[i].encode() for i in layer])
+            done.update(layer)
+        return layers
+
     def encode(self):
         ports = self.mapped_ports.split(',') if self.mapped_ports else []
         volumes = self.mapped_volumes.split(',') if self.mapped_volumes else []
@@ -515,6 +935,139 @@ class Deployment(Base):
             'environment_variables': dict([(p.property_key, p.property_value) for p in self.env_vars])
         }
 
+def _percentile(values, pct):
+    """
+    Nearest rank percentile of a sorted list
+    """
+    if not values:
+        return None
+    rank = int(math.ceil(pct / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+class DeploymentRun(Base):
+    """
+    A single launch of a deployment, with how long each
+    phase of it took on each host
+    """
+    __tablename__ = "deployment_runs"
+
+    id = Column(Integer, autoincrement=True, primary_key=True)
+    deployment_id = Column(Integer, ForeignKey("deployments.id"), index=True, nullable=False)
+    started_at = Column(DateTime, index=True)
+    finished_at = Column(DateTime)
+    outcome = Column(String(12), index=True)
+
+    phases = relationship("DeploymentRunPhase", backref="run", cascade="all, delete-orphan")
+
+    VALID_OUTCOMES = ['running', 'success', 'partial', 'failed']
+    PHASES = ['pull', 'stop', 'rm', 'create', 'start', 'healthy']
+
+    @staticmethod
+    def list_query(session, deployment_id, limit=20):
+        return session.query(DeploymentRun).filter(
+            DeploymentRun.deployment_id == deployment_id
+        ).order_by(desc(DeploymentRun.id)).limit(limit)
+
+    @staticmethod
+    def list(session, deployment_id, limit=20):
+        q = DeploymentRun.list_query(session, deployment_id, limit).options(selectinload(DeploymentRun.phases))
+        return [r.encode() for r in q.all()]
+
+    @staticmethod
+    def phase_stats(session, deployment_id, limit=100):
+        """
+        p50 and p95 duration of each phase over the deployment's
+        last `limit` runs, failed attempts included, and how many
+        of them failed
+        """
+        run_ids = [run_id for (run_id,) in DeploymentRun.list_query(
+            session, deployment_id, limit).with_entities(DeploymentRun.id).all()]
+        durations = dict([(phase, []) for phase in DeploymentRun.PHASES])
+        failures = dict([(phase, 0) for phase in DeploymentRun.PHASES])
+        if run_ids:
+            q = session.query(DeploymentRunPhase.phase, DeploymentRunPhase.duration,
+                              DeploymentRunPhase.failed).filter(
+                DeploymentRunPhase.run_id.in_(run_ids))
+            for phase, duration, failed in q.all():
+                durations.setdefault(phase, []).append(duration)
+                failures[phase] = failures.get(phase, 0) + (1 if failed else 0)
+
+        stats = {}
+        for phase in durations:
+            values = sorted(durations[phase])
+            stats[phase] = {
+                'count': len(values),
+                'failed': failures.get(phase, 0),
+                'p50': _percentile(values, 50),
+                'p95': _percentile(values, 95)
+            }
+        return stats
+
+    def encode(self):
+        return {
+            'id': self.id,
+            'started_at': self.started_at.strftime('%Y-%m-%d %H:%M:%S') if self.started_at else None,
+            'finished_at': self.finished_at.strftime('%Y-%m-%d %H:%M:%S') if self.finished_at else None,
+            'outcome': self.outcome,
+            'phases': [p.encode() for p in self.phases]
+        }
+
+class DeploymentRunPhase(Base):
+    __tablename__ = "deployment_run_phases"
+
+    id = Column(Integer, autoincrement=True, primary_key=True)
+    run_id = Column(Integer, ForeignKey("deployment_runs.id"), index=True, nullable=False)
+    hostname = Column(String(200))
+    app_name = Column(String(200))
+    phase = Column(String(12), index=True)
+    duration = Column(Float)
+    failed = Column(Boolean, default=False, nullable=False)
+
+    def encode(self):
+        return {
+            'host': self.hostname,
+            'app_name': self.app_name,
+            'phase': self.phase,
+            'duration': self.duration,
+            'failed': self.failed
+        }
+
+class Lease(Base):
+    """
+    Named lease held by a single mamabear process at a time, kept
+    alive by heartbeats and free for the taking once it expires
+    """
+    __tablename__ = "leases"
+
+    name = Column(String(100), primary_key=True)
+    owner = Column(String(200))
+    acquired_at = Column(DateTime)
+    heartbeat_at = Column(DateTime)
+    expires_at = Column(DateTime, index=True)
+
+class HostPollSchedule(Base):
+    """
+    When a host's containers are next due to be polled, and the
+    interval it is currently polled at
+    """
+    __tablename__ = "host_poll_schedules"
+
+    host_id = Column(Integer, ForeignKey("hosts.id"), primary_key=True)
+    interval = Column(Integer, nullable=False)
+    next_poll_at = Column(DateTime, index=True)
+    changed_at = Column(DateTime)
+
+class WorkerMember(Base):
+    """
+    Sharded worker process, alive for as long as it keeps
+    heartbeating
+    """
+    __tablename__ = "worker_members"
+
+    id = Column(String(200), primary_key=True)
+    started_at = Column(DateTime)
+    heartbeat_at = Column(DateTime, index=True)
+
 class EnvironmentVariable(Base):
     __tablename__ = "environment_variables"
 
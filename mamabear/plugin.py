@@ -1,15 +1,62 @@
+import time
+import logging
 import cherrypy
+import threading
 from cherrypy.process import wspbus, plugins
-from sqlalchemy import create_engine, asc, desc
+from sqlalchemy import create_engine, event, asc, desc
 from sqlalchemy.sql.expression import func, cast, and_
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import scoped_session, sessionmaker
+from mamabear.cache import invalidate, response_cache
+from mamabear.metrics import metrics
 
 Base = declarative_base()
 
+# Profile of the request being served by the current thread, if any
+_profiles = threading.local()
+
+class QueryProfile(object):
+    """
+    Statements executed while serving one request: how many, the
+    time spent in the database and the slowest of them
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.count = 0
+        self.db_time = 0.0
+        self.slowest = None
+        self.slowest_time = 0.0
+
+    def record(self, statement, duration):
+        self.count += 1
+        self.db_time += duration
+        if duration >= self.slowest_time:
+            self.slowest = statement
+            self.slowest_time = duration
+
+def profile_engine(engine):
+    """
+    Time the statements engine executes, for the profile of the
+    request executing them
+    """
+    if not event.contains(engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None and getattr(_profiles, 'current', None) is not None:
+        context._profile_started = time.time()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = getattr(_profiles, 'current', None)
+    started = getattr(context, '_profile_started', None)
+    if profile is not None and started is not None:
+        profile.record(statement, time.time() - started)
+
 class SAEnginePlugin(plugins.SimplePlugin):
     
-    def __init__(self, bus, connection_string=None):
+    def __init__(self, bus, connection_string=None, engine=None, replicas=None, replica_check=10):
         """
         The plugin is registered to the CherryPy engine and therefore
         is part of the bus (the engine *is* a bus) registery.
@@ -20,26 +67,64 @@ class SAEnginePlugin(plugins.SimplePlugin):
  
         Finally we create a new 'bind' channel that the SA tool
         will use to map a session to the SA engine at request time.
+
+        An existing engine can be given instead of a connection
+        string, so the requests share its connection pool.
+
+        Given a replica set, read only requests are bound to one of
+        its healthy replicas, falling back to the primary engine.
+        Replica health is checked every replica_check seconds.
+        For max_lag seconds after a write in this process, reads stay
+        on the primary, so no pre-write result gets cached or tagged
+        under the new cache generation.
         """
         plugins.SimplePlugin.__init__(self, bus)
         self.sa_engine = None
         self.bus.subscribe("bind", self.bind)
         self.connection_string = connection_string
+        self.engine = engine
+        self.replicas = replicas
+        if replicas:
+            plugins.Monitor(bus, replicas.check, frequency=replica_check,
+                            name='replica-check').subscribe()
 
     def start(self):        
-        self.sa_engine = create_engine(self.connection_string, echo=False)
+        self.sa_engine = self.engine or create_engine(self.connection_string, echo=False)
         Base.metadata.create_all(self.sa_engine)
+        profile_engine(self.sa_engine)
+        if self.replicas:
+            for engine in self.replicas.engines.values():
+                profile_engine(engine)
+            self.replicas.check()
 
     def stop(self):
         if self.sa_engine:
             self.sa_engine.dispose()
             self.sa_engine = None
+        if self.replicas:
+            self.replicas.dispose()
 
-    def bind(self, session):
-        session.configure(bind=self.sa_engine)
+    def bind(self, session, readonly=False):
+        """
+        Start the current thread's session on the engine for the
+        request
+        """
+        engine = None
+        if readonly and self.replicas and time.time() - response_cache.invalidated_at >= self.replicas.max_lag:
+            engine = self.replicas.pick()
+        session.registry.set(session.session_factory(bind=engine or self.sa_engine))
+
+def primary(handler):
+    """
+    Bind a handler's requests to the primary database, even GETs
+    """
+    if not hasattr(handler, '_cp_config'):
+        handler._cp_config = {}
+    handler._cp_config['tools.db.primary'] = True
+    return handler
 
 class SATool(cherrypy.Tool):
-    def __init__(self):
+    def __init__(self, profile_headers=True, slow_request=0):
         """
         The SA tool is responsible for associating a SA session
         to the SA engine and attaching it to the current request.
@@ -50,7 +135,17 @@ class SATool(cherrypy.Tool):
  
         This tools binds a session to the engine each time
         a requests starts and commits/rollbacks whenever
-        the request terminates.
+        the request terminates. Committing anything but a GET
+        invalidates the response cache.
+
+        GET requests may be served from a read replica, unless
+        the handler sets tools.db.primary because it writes or
+        must see the latest data.
+
+        The statements each request executes are profiled. The
+        query count and db time are sent in the X-Query-Count and
+        X-DB-Time headers, and requests taking slow_request seconds
+        or more are logged with their slowest statement.
         """
         cherrypy.Tool.__init__(self, 'on_start_resource',
                                self.bind_session,
@@ -58,23 +153,56 @@ class SATool(cherrypy.Tool):
  
         self.session = scoped_session(sessionmaker(autoflush=True,
                                                   autocommit=False))
+        self.profile_headers = profile_headers
+        self.slow_request = slow_request
  
     def _setup(self):
         cherrypy.Tool._setup(self)
         cherrypy.request.hooks.attach('on_end_resource',
                                       self.commit_transaction,
                                       priority=80)
+        if self.profile_headers:
+            cherrypy.request.hooks.attach('before_finalize',
+                                          self.send_profile,
+                                          priority=90)
  
-    def bind_session(self):
-        cherrypy.engine.publish('bind', self.session)
+    def bind_session(self, primary=False):
+        _profiles.current = QueryProfile()
+        readonly = cherrypy.request.method == 'GET' and not primary
+        cherrypy.engine.publish('bind', self.session, readonly)
         cherrypy.request.db = self.session
  
     def commit_transaction(self):
         cherrypy.request.db = None
         try:
             self.session.commit()
+            if cherrypy.request.method != 'GET':
+                invalidate()
         except:
             self.session.rollback()  
             raise
         finally:
             self.session.remove()
+            self.end_profile()
+
+    def send_profile(self):
+        profile = getattr(_profiles, 'current', None)
+        if profile is not None:
+            cherrypy.response.headers['X-Query-Count'] = str(profile.count)
+            cherrypy.response.headers['X-DB-Time'] = '%.4f' % profile.db_time
+
+    def end_profile(self):
+        profile = getattr(_profiles, 'current', None)
+        _profiles.current = None
+        if profile is None:
+            return
+        elapsed = time.time() - profile.started
+        metrics.observe('http.db_time', profile.db_time)
+        metrics.incr('http.queries', profile.count)
+        if self.slow_request and elapsed >= self.slow_request:
+            metrics.incr('http.slow_requests')
+            cherrypy.log.error(
+                "Slow request {} {}: {:.3f}s, {} queries, {:.3f}s in db, slowest ({:.3f}s): {}".format(
+                    cherrypy.request.method, cherrypy.request.path_info, elapsed, profile.count,
+                    profile.db_time, profile.slowest_time, (profile.slowest or '')[:500]),
+                context='PROFILE', severity=logging.WARNING)
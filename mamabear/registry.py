@@ -0,0 +1,92 @@
+import logging
+import requests
+import threading
+from multiprocessing.pool import ThreadPool
+from requests.adapters import HTTPAdapter
+
+logging.basicConfig(level=logging.INFO)
+
+class RegistryClient(object):
+    """
+    Client for the docker registry tags api. Requests go through one
+    keep-alive session and are made conditional on the ETag and
+    Last-Modified validators of the previous response, so unchanged
+    tag lists come back as an empty 304 and are served from memory.
+    """
+
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, registry_url, username, password=None, threads=8):
+        self.registry_url = registry_url
+        self.username = username
+        self.password = password
+        self.threads = threads
+        self._cache = {} # url -> (validator headers, tags)
+        self._cache_lock = threading.Lock()
+
+        self._session = requests.Session()
+        if password:
+            self._session.auth = (username, password)
+        adapter = HTTPAdapter(pool_connections=threads, pool_maxsize=threads)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+    @classmethod
+    def shared(cls, registry_url, username, password=None, threads=8):
+        """
+        Process wide client for a registry and user, so cached tag
+        lists outlive any single worker
+        """
+        key = (registry_url, username, password)
+        with cls._shared_lock:
+            if key not in cls._shared:
+                cls._shared[key] = cls(registry_url, username, password, threads=threads)
+            return cls._shared[key]
+
+    def tags_url(self, app_name):
+        return "%s/repositories/%s/%s/tags" % (self.registry_url, self.username, app_name)
+
+    def tags(self, app_name):
+        url = self.tags_url(app_name)
+        with self._cache_lock:
+            validators, cached = self._cache.get(url, ({}, None))
+
+        logging.info("Fetching url: {}".format(url))
+        r = self._session.get(url, headers=validators)
+        if r.status_code == 304 and cached is not None:
+            logging.info("Tags for {} not modified".format(app_name))
+            return cached
+        r.raise_for_status()
+
+        tags = r.json()
+        validators = {}
+        if 'ETag' in r.headers:
+            validators['If-None-Match'] = r.headers['ETag']
+        if 'Last-Modified' in r.headers:
+            validators['If-Modified-Since'] = r.headers['Last-Modified']
+        if validators:
+            with self._cache_lock:
+                self._cache[url] = (validators, tags)
+        return tags
+
+    def _tags_or_error(self, app_name):
+        try:
+            return app_name, self.tags(app_name)
+        except Exception as e:
+            return app_name, e
+
+    def tags_for_apps(self, app_names):
+        """
+        Fetch tags for every app concurrently. Returns a map of app
+        name to its tags, or to the exception raised fetching them.
+        """
+        app_names = list(app_names)
+        if not app_names:
+            return {}
+        pool = ThreadPool(min(self.threads, len(app_names)))
+        try:
+            return dict(pool.map(self._tags_or_error, app_names))
+        finally:
+            pool.close()
+            pool.join()
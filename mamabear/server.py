@@ -8,8 +8,15 @@ import cherrypy
 import ConfigParser
 from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
 from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.schedulers.blocking import BlockingScheduler
 
 from mamabear.worker import Worker
+from mamabear.db import get_engine, get_replicas
+from mamabear.model import detect_search_indexes
+from mamabear.config import get_option
+from mamabear.cache import response_cache
+from mamabear.events import EventSubscribers
+from mamabear.shard import ShardMembership
 from mamabear.controllers import *
 from mamabear.plugin import SAEnginePlugin, SATool
 
@@ -30,6 +37,7 @@ def get_app():
     d.connect(name='mamabear-deployments', route='/mamabear', controller=DeploymentController)
     d.connect(name='mamabear-images', route='/mamabear', controller=ImageController)
     d.connect(name='mamabear-containers', route='/mamabear', controller=ContainerController)
+    d.connect(name='mamabear-metrics', route='/mamabear', controller=MetricsController)
     
     with d.mapper.submapper(path_prefix='/mamabear/v1', controller='mamabear-hosts') as m:
         m.connect('hosts', '/host', action='list_hosts', conditions=dict(method=['GET']))
@@ -44,9 +52,13 @@ def get_app():
         m.connect('container_get', '/container/{container_id}', action='get_container', conditions=dict(method=['GET']))
         m.connect('container_get_logs', '/container/{container_id}/logs', action='get_container_logs', conditions=dict(method=['GET']))
 
+    with d.mapper.submapper(path_prefix='/mamabear/v1', controller='mamabear-metrics') as m:
+        m.connect('metrics', '/metrics', action='get_metrics', conditions=dict(method=['GET']))
+
     with d.mapper.submapper(path_prefix='/mamabear/v1', controller='mamabear-deployments') as m:
         m.connect('deployments_all', '/deployment', action='list_deployments', conditions=dict(method=['GET']))
         m.connect('deployment', '/deployment/{app_name}/{image_tag}/{environment}', action='get_deployment', conditions=dict(method=['GET']))
+        m.connect('deployment_runs', '/deployment/{app_name}/{image_tag}/{environment}/runs', action='deployment_runs', conditions=dict(method=['GET']))
         m.connect('run_deployment', '/deployment/{app_name}/{image_tag}/{environment}/run', action='run_deployment')
         m.connect('delete_deployment', '/deployment/{app_name}/{image_tag}/{environment}', action='delete_deployment', conditions=dict(method=['DELETE']))
         m.connect('update_deployment', '/deployment/{app_name}/{image_tag}/{environment}', action='update_deployment', conditions=dict(method=['PUT']))
@@ -96,15 +108,14 @@ def start(config):
     DeploymentController.worker = Worker(config)
     ContainerController.worker = Worker(config)
     
-    connection_string = "mysql://%s:%s@%s/%s" % (
-        config.get('mysql', 'user'),
-        config.get('mysql', 'passwd'),
-        config.get('mysql', 'host'),
-        config.get('mysql', 'database')
-    )
-
-    SAEnginePlugin(cherrypy.engine, connection_string).subscribe()
-    cherrypy.tools.db = SATool()
+    response_cache.configure(config)
+    engine = get_engine(config)
+    detect_search_indexes(engine)
+    SAEnginePlugin(cherrypy.engine, engine=engine, replicas=get_replicas(config),
+                   replica_check=get_option(config, 'mysql', 'replica_check', 10)).subscribe()
+    cherrypy.tools.db = SATool(
+        profile_headers=get_option(config, 'profile', 'headers', True),
+        slow_request=get_option(config, 'profile', 'slow_request', 1.0))
     cherrypy.tools.cors = cherrypy.Tool('before_handler', cors)
     
     cherrypy.engine.start()
@@ -113,38 +124,95 @@ def start(config):
 
 def update_all_job(config):
     worker = Worker(config)
-    worker.update_all()
+    worker.sweep()
+
+def update_containers_job(config):
+    worker = Worker(config)
+    worker.sweep_containers()
     
 def start_worker(config):
-    connection_string = "mysql://%s:%s@%s/%s" % (
-        config.get('mysql', 'user'),
-        config.get('mysql', 'passwd'),
-        config.get('mysql', 'host'),
-        config.get('mysql', 'database')
-    )
-    
     scheduler = BackgroundScheduler()
-    scheduler.add_jobstore(SQLAlchemyJobStore(url=connection_string), alias='db')
+    scheduler.add_jobstore(SQLAlchemyJobStore(engine=get_engine(config)), alias='db')
     scheduler.start()
     scheduler.add_job(
         update_all_job, args=[config], replace_existing=True, id='worker',
-        trigger='cron', minute='*/5', jobstore='db', timezone='UTC')
+        trigger='cron', minute='*/5', jobstore='db', timezone='UTC',
+        coalesce=True, max_instances=1, misfire_grace_time=60)
+
+    if get_option(config, 'worker', 'adaptive_polling', False):
+        scheduler.add_job(
+            update_containers_job, args=[config], replace_existing=True, id='containers',
+            trigger='cron', minute='*', jobstore='db', timezone='UTC',
+            coalesce=True, max_instances=1, misfire_grace_time=30)
+    elif scheduler.get_job('containers', jobstore='db'):
+        # Left behind in the job store from when polling was adaptive
+        scheduler.remove_job('containers', jobstore='db')
+
+    if get_option(config, 'worker', 'events', False):
+        EventSubscribers(Worker(config), config).start()
     
+def shard_heartbeat_job(membership):
+    try:
+        membership.heartbeat()
+    finally:
+        membership.db.remove()
+
+def start_shard_worker(config):
+    """
+    Run as one of several worker processes, each sweeping the hosts
+    it owns on a consistent hash ring over the live workers
+    """
+    worker = Worker(config)
+    membership = ShardMembership(
+        worker.get_session(get_engine(config)),
+        ttl=get_option(config, 'worker', 'shard_ttl', 90))
+    membership.heartbeat()
+
+    scheduler = BlockingScheduler()
+    scheduler.add_job(
+        shard_heartbeat_job, args=[membership], id='heartbeat', trigger='interval',
+        seconds=get_option(config, 'worker', 'shard_heartbeat', 30),
+        coalesce=True, max_instances=1)
+    adaptive = get_option(config, 'worker', 'adaptive_polling', False)
+    scheduler.add_job(
+        worker.sweep_shard, args=[membership], kwargs={'containers': not adaptive}, id='worker',
+        trigger='cron', minute='*/5', timezone='UTC',
+        coalesce=True, max_instances=1, misfire_grace_time=60)
+    if adaptive:
+        scheduler.add_job(
+            worker.sweep_shard, args=[membership], kwargs={'apps': False}, id='containers',
+            trigger='cron', minute='*', timezone='UTC',
+            coalesce=True, max_instances=1, misfire_grace_time=30)
+
+    if get_option(config, 'worker', 'events', False):
+        EventSubscribers(worker, config, membership=membership).start()
+
+    try:
+        scheduler.start()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        membership.leave()
+
 if __name__ == '__main__':
     argv = sys.argv[1:]
     conf = None
+    shard = False
 
     try:
-        opts, args = getopt.getopt(argv, "hc:")
+        opts, args = getopt.getopt(argv, "hc:w")
     except getopt.GetoptError:
-        print 'Usage: server.py -c <configFile>'
+        print 'Usage: server.py -c <configFile> [-w]'
         sys.exit(2)
 
     for opt, arg in opts:
         if opt == "-h":
-            print 'Usage: server.py -c <configFile>'
+            print 'Usage: server.py -c <configFile> [-w]'
+            print '  -w  run as a sharded worker only, without the web app'
         elif opt == "-c":
             conf = arg
+        elif opt == "-w":
+            shard = True
 
     if conf is None:
         print "Config file must be given. Usage: server.py -c <conf>'"
@@ -153,5 +221,11 @@ if __name__ == '__main__':
     c = ConfigParser.ConfigParser()
     c.readfp(open(conf))
 
-    start_worker(c)
-    start(c)    
+    if shard:
+        start_shard_worker(c)
+        sys.exit(0)
+
+    # With sharded workers running, the web app leaves sweeping to them
+    if not get_option(c, 'worker', 'shards', False):
+        start_worker(c)
+    start(c)
@@ -0,0 +1,76 @@
+import bisect
+import hashlib
+import logging
+from datetime import datetime, timedelta
+from mamabear.model import *
+from mamabear.lease import default_owner
+
+logging.basicConfig(level=logging.INFO)
+
+class HashRing(object):
+    """
+    Consistent hash ring over worker members. Each member is placed
+    on the ring `replicas` times, so when a member joins or leaves
+    only its share of the keys moves.
+    """
+
+    def __init__(self, members, replicas=100):
+        self._ring = sorted([(self._hash('{}#{}'.format(member, i)), member)
+                             for member in members for i in range(replicas)])
+        self._points = [point for point, member in self._ring]
+
+    @staticmethod
+    def _hash(key):
+        return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+    def owner(self, key):
+        if not self._ring:
+            return None
+        i = bisect.bisect(self._points, self._hash(key)) % len(self._ring)
+        return self._ring[i][1]
+
+class ShardMembership(object):
+    """
+    A worker's row in the membership table. Members that haven't
+    heartbeated for `ttl` seconds are no longer considered live, so
+    their hosts move to the remaining members.
+    """
+
+    def __init__(self, db, member_id=None, ttl=90, replicas=100):
+        self.db = db
+        self.member_id = member_id or default_owner()
+        self.ttl = ttl
+        self.replicas = replicas
+
+    def heartbeat(self):
+        now = datetime.utcnow()
+        try:
+            member = self.db.query(WorkerMember).get(self.member_id)
+            if not member:
+                logging.info("Worker {} joining".format(self.member_id))
+                member = WorkerMember(id=self.member_id, started_at=now)
+            member.heartbeat_at = now
+            self.db.add(member)
+            self.db.commit()
+        except:
+            self.db.rollback()
+            raise
+
+    def leave(self):
+        logging.info("Worker {} leaving".format(self.member_id))
+        self.db.query(WorkerMember).filter(WorkerMember.id == self.member_id).delete(
+            synchronize_session=False)
+        self.db.commit()
+
+    def live_members(self):
+        cutoff = datetime.utcnow() - timedelta(seconds=self.ttl)
+        return [member_id for (member_id,) in self.db.query(WorkerMember.id).filter(
+            WorkerMember.heartbeat_at >= cutoff).all()]
+
+    def owned_host_ids(self):
+        """
+        Ids of the hosts this member owns on the current ring
+        """
+        ring = HashRing(self.live_members(), self.replicas)
+        return [host_id for (host_id, hostname) in self.db.query(Host.id, Host.hostname).all()
+                if ring.owner(hostname) == self.member_id]
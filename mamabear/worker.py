@@ -1,15 +1,20 @@
 import time
+import docker
 import logging
-import requests
 import threading
 from dateutil import tz
 from dateutil import parser
-from datetime import datetime
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
+from mamabear.db import get_engine, get_session
 from mamabear.model import *
+from mamabear.lease import DBLease, LeaseLost
+from mamabear.config import get_option
+from mamabear.metrics import metrics
+from mamabear.cache import mark_written
+from mamabear.health import HealthChecker
+from mamabear.registry import RegistryClient
 from mamabear.docker_wrapper import DockerWrapper
-from sqlalchemy import create_engine
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import scoped_session, sessionmaker
 
 logging.basicConfig(level=logging.INFO)
 
@@ -19,19 +24,15 @@ class Worker(object):
     update data in the db
     """
 
+    # Docker container events applied by the events subscriber
+    LIFECYCLE_EVENTS = ['start', 'restart', 'die', 'kill', 'stop', 'oom']
+    PAUSE_EVENT_STATES = {'pause': 'paused', 'unpause': 'running'}
+
     def get_engine(self, config):
-        return create_engine('mysql://%s:%s@%s/%s' % (
-            config.get('mysql', 'user'),
-            config.get('mysql', 'passwd'),
-            config.get('mysql', 'host'),
-            config.get('mysql', 'database')
-        ), echo=False)    
-
-    def get_session(self, engine):    
-        sess = scoped_session(sessionmaker(autoflush=True,
-                                       autocommit=False))
-        sess.configure(bind=engine)
-        return sess
+        return get_engine(config)
+
+    def get_session(self, engine):
+        return get_session(engine)
 
     def __init__(self, config, updateOnStart=False):        
         self._config = config
@@ -41,6 +42,12 @@ class Worker(object):
         # Registry user is *required*
         self._registry_user = config.get('registry', 'user')
         self._registry_password = config.get('registry', 'password')
+        # Container state is pushed by docker event subscribers
+        # rather than polled by the periodic sweep
+        self._events = get_option(config, 'worker', 'events', False)
+        # Each host is polled on its own schedule, by a container
+        # sweep that runs every minute and only visits due hosts
+        self._adaptive = get_option(config, 'worker', 'adaptive_polling', False)
         if updateOnStart:            
             self.update_all()
         
@@ -51,42 +58,61 @@ class Worker(object):
         image_ref = self.image_ref(app_name, image_tag)
         return Container.get_by_ref(db, image_ref)
         
-    def update_app_images(self, db, app):
+    def registry(self):
+        return RegistryClient.shared(
+            self._registry_url, self._registry_user, self._registry_password,
+            threads=get_option(self._config, 'registry', 'threads', 8))
+
+    def update_app_images(self, db, app, images=None):
         """
         Update images for app from docker registry. If we know
         about existing containers that reference a newly fetched
-        image, we attach the containers to the image 
+        image, we attach the containers to the image. Tags already
+        fetched for the app can be passed in as images.
         """
-        logging.info("Fetching images for {} from {} ...".format(app.name, self._registry_url))
-        images = DockerWrapper.list_images(
-            self._registry_url, app.name, self._registry_user, self._registry_password)
-        for image_info in images:
-            image = Image.get(db, image_info['layer'])
-            if image:
-                logging.info("Found existing image {}, updating tag to {}".format(image_info['layer'], image_info['name']))
-                image.tag = image_info['name']
-            else:
-                logging.info("Found new image {}, setting tag to {}".format(image_info['layer'], image_info['name']))
-                image = Image(id=image_info['layer'], tag=image_info['name'])
+        if images is None:
+            logging.info("Fetching images for {} from {} ...".format(app.name, self._registry_url))
+            images = self.registry().tags(app.name)
 
-            for container in self.containers_for_app_image(db, app.name, image.tag):
+        # Later tags for the same layer win, as the registry lists them
+        tags = dict([(image_info['layer'], image_info['name']) for image_info in images])
+        refs = dict([(self.image_ref(app.name, image_info['name']), image_info['layer']) for image_info in images])
+        if not tags:
+            return
+
+        known = dict([(image.id, image) for image in
+                      db.query(Image).filter(Image.id.in_(tags.keys())).all()])
+        containers = db.query(Container).filter(Container.image_ref.in_(refs.keys())).all()
+
+        for layer in tags:
+            image = known.get(layer)
+            if not image:
+                logging.info("Found new image {}, setting tag to {}".format(layer, tags[layer]))
+                image = Image(id=layer, tag=tags[layer], app_name=app.name)
+                known[layer] = image
+                db.add(image)
+            elif image.tag != tags[layer] or image.app_name != app.name:
+                logging.info("Found existing image {}, updating tag to {}".format(layer, tags[layer]))
+                image.tag = tags[layer]
+                image.app_name = app.name
+
+        for container in containers:
+            image = known[refs[container.image_ref]]
+            if container.image_id != image.id:
                 logging.info("Found container {} with state: [{}], associated with image: {}, linking".format(
                     container.id, container.state, image.id
                 ))
-                image.containers.append(container)
-            
-            app.images.append(image)
-            db.add(image)
-            db.add(app)
+                container.image = image
         db.commit()
 
-    def update_deployment_containers(self, db, deployment, config):
+    def update_deployment_containers(self, db, deployment, config, refresh_hosts=True):
         """
         Update container state for all containers on the deployment's configured hosts.
         """
-        for host in deployment.hosts:
-            logging.info("Updating containers for host: {}".format(host.hostname))
-            self.update_host_containers(db, host, config)
+        if refresh_hosts:
+            for host in deployment.hosts:
+                logging.info("Updating containers for host: {}".format(host.hostname))
+                self.update_host_containers(db, host, config)
 
         for container in self.containers_for_app_image(db, deployment.app_name, deployment.image_tag):
             logging.info("Found container {} with state: [{}], associated with deployment: {}, linking".format(
@@ -97,166 +123,651 @@ class Worker(object):
         db.add(deployment)
         db.commit()
 
-    def _check_app_status(self, url, timeout=10, retry=3):
-        last_exception = None
-        for attempt in range(1, retry+1):
-            try:
-                r = requests.get(url, timeout=timeout)
-                if r.ok:
-                    return 'up'
-                else:
-                    return 'down'
-            except Exception as e:
-                logging.warn("Failed to check status of: {}, reason: [{}]".format(url, e.message))
-                time.sleep(5)
-                last_exception = e
-        else:
-            raise last_exception
-
-    def update_deployment(self, db, deployment):
-        self.update_deployment_containers(db, deployment, self._config)
+    def update_deployment(self, db, deployment, refresh_hosts=None):
+        if refresh_hosts is None:
+            refresh_hosts = not self._events
+        self.update_deployment_containers(db, deployment, self._config,
+                                          refresh_hosts=refresh_hosts)
         self.update_deployment_status(db, deployment)
                         
     def update_deployment_status(self, db, deployment):
         """
-        Update app status for all of the deployment's containers
+        Update app status for all of the deployment's containers. The
+        status endpoints of all running containers are probed at once,
+        and the results written back in a single commit.
         """
+        status_urls = {}
         for container in deployment.containers:
             if container.state == 'running':
-                status_url = "http://%s:%s/%s" % (
+                status_urls[container.id] = "http://%s:%s/%s" % (
                     container.host.hostname,
                     deployment.status_port,
                     deployment.status_endpoint)
-                
-                logging.info("Checking status of {} for container: {}".format(status_url, container.id))
-                try:
-                    status = self._check_app_status(status_url)
-                    logging.info("Got status of {} for container: {}".format(status, container.id))
-                    container.status = status
-                except Exception as e:
-                    logging.warn("Failed to check status, {}".format(e.message))
-                    container.status = 'down'                
+
+        logging.info("Checking status of {} containers for deployment: {}".format(
+            len(status_urls), deployment.name()))
+        statuses = HealthChecker.shared(self._config).check_all(status_urls.values())
+
+        for container in deployment.containers:
+            if container.id in status_urls:
+                container.status = statuses[status_urls[container.id]]
+                logging.info("Got status of {} for container: {}".format(container.status, container.id))
             else:
-                container.status = 'down'                
+                container.status = 'down'
             db.add(container)
         db.commit()
-        
+
+    def _local_time(self, timestamp):
+        """
+        Docker timestamp as a naive local time, truncated to whole
+        seconds like the DATETIME columns it's compared with
+        """
+        return parser.parse(timestamp).astimezone(tz.tzlocal()).replace(tzinfo=None, microsecond=0)
+
+    def update_container(self, db, host, info):
+        """
+        Create or update a single container on host from the detail
+        information returned by the docker wrapper
+        """
+        container = Container.get(db, info['id'])
+        if container:
+            logging.info("Found existing container {}, updating state to: {}".format(info['id'], info['state']))
+            container.state = info['state']
+            container.started_at = self._local_time(info['started_at'])
+            container.finished_at = self._local_time(info['finished_at'])
+            db.add(container)
+        else:
+            logging.info("Got new container {}, setting state to: {}".format(info['id'], info['state']))
+            image_layer = info['image_id'][0:8]
+            image = Image.get(db, image_layer)
+            container = Container(
+                id=info['id'],
+                image_ref=info['image_ref'],
+                state = info['state'],
+                started_at = self._local_time(info['started_at']),
+                finished_at = self._local_time(info['finished_at'])
+            )
+            if 'command' in info:
+                container.command = info['command']
+            if image:
+                container.image = image
+            host.containers.append(container)
+            db.add(container)
+        return container
+
+    def apply_container_event(self, db, host, wrapper, event):
+        """
+        Apply a single docker event for a container on host. Pause
+        and unpause only flip the state; other lifecycle events
+        re-inspect the container so times and state stay exact.
+        Returns True if the container row changed.
+        """
+        action = event.get('Action') or event.get('status')
+        container_id = event.get('id') or event.get('Actor', {}).get('ID')
+        if event.get('Type', 'container') != 'container' or not container_id:
+            return False
+
+        if action == 'destroy':
+            container = Container.get(db, container_id)
+            if container:
+                logging.info("Container {} destroyed on {}, removing".format(container_id, host.hostname))
+                db.delete(container)
+                db.commit()
+                return True
+            return False
+
+        if action in self.PAUSE_EVENT_STATES:
+            container = Container.get(db, container_id)
+            if container:
+                logging.info("Container {} on {} {}d".format(container_id, host.hostname, action))
+                container.state = self.PAUSE_EVENT_STATES[action]
+                db.add(container)
+                db.commit()
+                return True
+
+        if action in self.LIFECYCLE_EVENTS or action in self.PAUSE_EVENT_STATES:
+            try:
+                info = wrapper.container_state(container_id)
+            except docker.errors.NotFound:
+                # Already removed, e.g. started with --rm; its destroy event follows
+                container = Container.get(db, container_id)
+                if container:
+                    logging.info("Container {} is gone from {}, removing".format(container_id, host.hostname))
+                    db.delete(container)
+                    db.commit()
+                    return True
+                return False
+            self.update_container(db, host, info)
+            db.add(host)
+            db.commit()
+            return True
+        return False
+
     def update_host_containers(self, db, host, config):
         """
         For a given host, update the application status and container
-        state for all containers.
+        state for all containers. The host's known containers and the
+        images of new ones are each loaded in a single query, and only
+        rows that changed are written, in bulk. Returns the number of
+        containers inserted, updated or removed, or None when the host
+        couldn't be polled.
         """
         wrapper = DockerWrapper(host.hostname, host.port, config)
         host_container_info = []
+        failed = False
 
-        # Keep track of containers that go away
-        previous_host_containers = dict([(container.id, container) for container in host.containers])
-        new_host_containers = set()
-        
         try:
-            host_container_info = wrapper.state_of_the_universe()
+            host_container_info = wrapper.state_of_the_universe(
+                incremental=get_option(config, 'worker', 'incremental_sweep', False),
+                threads=get_option(config, 'worker', 'inspect_threads', 1))
         except Exception as e:
             logging.error(e)
+            wrapper.forget_universe()
             host.status = 'down'
             db.add(host)
-        
+            failed = True
+
+        # Containers on this host, plus any reported containers we
+        # know about from elsewhere
+        container_ids = [info['id'] for info in host_container_info]
+        q = db.query(Container.id, Container.host_id, Container.state,
+                     Container.started_at, Container.finished_at)
+        if container_ids:
+            q = q.filter(or_(Container.host_id == host.id, Container.id.in_(container_ids)))
+        else:
+            q = q.filter(Container.host_id == host.id)
+        known = dict([(row.id, row) for row in q.all()])
+
+        new_layers = set([info['image_id'][0:8] for info in host_container_info if info['id'] not in known])
+        images = set()
+        if new_layers:
+            images = set([image_id for (image_id,) in db.query(Image.id).filter(Image.id.in_(new_layers)).all()])
+
+        parsed = {}
+        def local_time(timestamp):
+            if timestamp not in parsed:
+                parsed[timestamp] = self._local_time(timestamp)
+            return parsed[timestamp]
+
+        inserts = []
+        updates = []
         for info in host_container_info:
-            container = Container.get(db, info['id'])
-            new_host_containers.add(info['id'])
-            if container:
-                logging.info("Found existing container {}, updating state to: {}".format(info['id'], info['state']))
-                container.state = info['state']
-                container.finished_at = parser.parse(info['finished_at']).astimezone(tz.tzlocal()).replace(tzinfo=None)
-                db.add(container)
+            values = {
+                'id': info['id'],
+                'host_id': host.id,
+                'state': info['state'],
+                'started_at': local_time(info['started_at']),
+                'finished_at': local_time(info['finished_at'])
+            }
+            row = known.get(info['id'])
+            if row:
+                if (row.host_id, row.state, row.started_at, row.finished_at) != (
+                        host.id, values['state'], values['started_at'], values['finished_at']):
+                    logging.info("Found changed container {}, updating state to: {}".format(info['id'], info['state']))
+                    updates.append(values)
             else:
                 logging.info("Got new container {}, setting state to: {}".format(info['id'], info['state']))
+                values['image_ref'] = info['image_ref']
+                values['command'] = info.get('command')
                 image_layer = info['image_id'][0:8]
-                image = Image.get(db, image_layer)
-                container = Container(
-                    id=info['id'],
-                    image_ref=info['image_ref'],
-                    state = info['state'],
-                    started_at = parser.parse(info['started_at']).astimezone(tz.tzlocal()).replace(tzinfo=None),
-                    finished_at = parser.parse(info['finished_at']).astimezone(tz.tzlocal()).replace(tzinfo=None)
-                )
-                if 'command' in info:
-                    container.command = info['command']
-                if image:
-                    container.image = image
-                host.containers.append(container)
-                db.add(container)
+                values['image_id'] = image_layer if image_layer in images else None
+                inserts.append(values)
+
+        # Keep track of containers that go away
+        current = set(container_ids)
+        removed = [c_id for c_id in known if known[c_id].host_id == host.id and c_id not in current]
+        for c_id in removed:
+            logging.info("Previous container {} not found on host, removing".format(c_id))
+
+        if inserts:
+            db.bulk_insert_mappings(Container, inserts)
+        if updates:
+            db.bulk_update_mappings(Container, updates)
+        if inserts or updates:
+            # Bulk mappings bypass the flush events the cache listens to
+            mark_written(db)
+        if removed:
+            db.query(Container).filter(Container.id.in_(removed)).delete(synchronize_session=False)
 
-        for c_id in previous_host_containers:
-            if c_id not in new_host_containers:
-                logging.info("Previous container {} not found on host, removing".format(c_id))
-                container = previous_host_containers[c_id]
-                db.delete(container)
-                
         db.add(host)
         db.commit()
-                        
-    def update_all_containers(self, db, config):
+        if failed:
+            return None
+        return len(inserts) + len(updates) + len(removed)
+
+    def due_host_ids(self, db, host_ids):
         """
-        Updates every app and container state on all hosts
+        The hosts among host_ids whose next poll is due, including
+        hosts that have never been scheduled
         """
-        for host in db.query(Host).all():
-            logging.info("Updating containers for host: {}".format(host.hostname))
-            self.update_host_containers(db, host, config)
+        if not host_ids:
+            return []
+        now = datetime.utcnow()
+        scheduled = dict(db.query(HostPollSchedule.host_id, HostPollSchedule.next_poll_at).filter(
+            HostPollSchedule.host_id.in_(host_ids)).all())
+        return [host_id for host_id in host_ids
+                if not scheduled.get(host_id) or scheduled[host_id] <= now]
+
+    def reschedule_host(self, db, host_id, changes, reset=False):
+        """
+        Pick the host's next poll time. The poll interval shrinks by
+        [worker] poll_factor when the last poll saw changes, drops to
+        poll_min after a deploy (reset), and grows by poll_factor while
+        the host stays stable, always within poll_min and poll_max.
+        A failed poll (changes is None) backs off like a stable one, so
+        an unreachable host isn't hammered.
+        """
+        poll_min = get_option(self._config, 'worker', 'poll_min', 60)
+        poll_max = get_option(self._config, 'worker', 'poll_max', 1800)
+        factor = get_option(self._config, 'worker', 'poll_factor', 2.0)
+        now = datetime.utcnow()
+
+        schedule = db.query(HostPollSchedule).get(host_id)
+        if not schedule:
+            schedule = HostPollSchedule(host_id=host_id, interval=poll_min)
+        if reset:
+            schedule.interval = poll_min
+        elif changes:
+            schedule.interval = int(schedule.interval / factor)
+        else:
+            schedule.interval = int(schedule.interval * factor)
+        schedule.interval = min(max(schedule.interval, poll_min), poll_max)
+        if changes or reset:
+            schedule.changed_at = now
+        schedule.next_poll_at = now + timedelta(seconds=schedule.interval)
+        db.add(schedule)
+        db.commit()
+
+    def _sweep_host(self, db, host_id, config, lease=None):
+        """
+        Update containers for a single host, returning the hostname
+        and how long the update took. A failure is logged and rolled
+        back without affecting other hosts, and the host is skipped
+        once the sweep's lease is lost. Runs on a sweep thread or the
+        caller's, so the host is loaded with (and the session released
+        from) the running thread's own session.
+        """
+        started = time.time()
+        hostname = None
+        try:
+            if lease:
+                lease.check()
+            host = db.query(Host).get(host_id)
+            hostname = host.hostname
+            logging.info("Updating containers for host: {}".format(hostname))
+            changes = self.update_host_containers(db, host, config)
+            if self._adaptive:
+                self.reschedule_host(db, host_id, changes)
+        except LeaseLost:
+            return None, 0
+        except Exception as e:
+            logging.error("Failed updating containers for host: {}, reason: [{}]".format(hostname or host_id, e))
+            db.rollback()
+        finally:
+            db.remove()
+        return hostname or host_id, time.time() - started
+
+    def update_all_containers(self, db, config, host_ids=None, lease=None):
+        """
+        Updates every app and container state on all hosts, or just
+        the hosts with the given ids. Hosts are swept in parallel by up
+        to [worker] sweep_threads threads, each with its own session;
+        returns a map of hostname to the seconds spent updating it.
+        Given the lease guarding the sweep, raises LeaseLost once it's
+        lost, leaving the remaining hosts to the new holder.
+        """
+        if host_ids is None:
+            host_ids = [host_id for (host_id,) in db.query(Host.id).all()]
+        if self._adaptive:
+            host_ids = self.due_host_ids(db, host_ids)
+        threads = min(get_option(config, 'worker', 'sweep_threads', 1), len(host_ids))
+        started = time.time()
+        timings = {}
+
+        sweep_host = lambda host_id: self._sweep_host(db, host_id, config, lease)
+        if threads > 1:
+            # The scoped session is thread local, so every pool thread
+            # gets a session of its own from the same registry
+            pool = ThreadPool(threads)
+            try:
+                results = list(pool.imap_unordered(sweep_host, host_ids))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [sweep_host(host_id) for host_id in host_ids]
+
+        for hostname, elapsed in results:
+            if hostname is not None:
+                timings[hostname] = elapsed
+
+        if lease:
+            lease.check()
+        for hostname in sorted(timings, key=timings.get, reverse=True):
+            logging.info("Swept host {} in {:.2f}s".format(hostname, timings[hostname]))
+        logging.info("Swept {} hosts with {} thread(s) in {:.2f}s".format(
+            len(timings), max(threads, 1), time.time() - started))
+        return timings
 
     def get_container_logs(self, container, config, stderr=True, stdout=False, limit=100):
         wrapper = DockerWrapper(container.host.hostname, container.host.port, config)
         return wrapper.logs(container.id, stdout=stdout, stderr=stderr, tail=limit)
         
-    def update_all(self):
+    def sweep(self):
+        """
+        Run update_all under the fleet wide sweep lease, skipping the
+        run when another sweep (here or in another mamabear) holds it
+        """
+        db = self.get_session(self.get_engine(self._config))
+        lease = DBLease(db, 'sweep',
+                        ttl=get_option(self._config, 'worker', 'lease_ttl', 120),
+                        heartbeat=get_option(self._config, 'worker', 'lease_heartbeat', 30))
         try:
-            db = self.get_session(self.get_engine(self._config))
-        
-            apps = db.query(App).all()
-            for app in apps:
-                logging.info("Updating image and deployment information for {}".format(app.name))
+            with lease as held:
+                if not held:
+                    logging.info("Another sweep holds the lease, skipping this run")
+                    metrics.incr('sweep.skipped')
+                    return
+                started = time.time()
                 try:
-                    self.update_app_images(db, app)
+                    self.update_all(lease=lease)
+                except LeaseLost as e:
+                    logging.warn("Aborting sweep, {}".format(e))
+                    metrics.incr('sweep.aborted')
+                    return
+                metrics.incr('sweep.runs')
+                metrics.observe('sweep.duration', time.time() - started)
+        finally:
+            db.remove()
+
+    def sweep_shard(self, membership, apps=True, containers=True):
+        """
+        Sweep the containers of the hosts this shard owns. App images
+        and deployment status are fleet wide, so whichever shard holds
+        the sweep lease refreshes them, leaving hosts to their owners.
+        """
+        db = membership.db
+        try:
+            membership.heartbeat()
+            metrics.incr('shard.sweeps')
+
+            if apps:
+                lease = DBLease(db, 'sweep',
+                                ttl=get_option(self._config, 'worker', 'lease_ttl', 120),
+                                heartbeat=get_option(self._config, 'worker', 'lease_heartbeat', 30))
+                with lease as held:
+                    if held:
+                        try:
+                            self.update_apps(db, refresh_hosts=False, lease=lease)
+                        except LeaseLost as e:
+                            logging.warn("Aborting app sweep, {}".format(e))
+                            metrics.incr('sweep.aborted')
+
+            if containers and not self._events:
+                host_ids = membership.owned_host_ids()
+                logging.info("Worker {} owns {} hosts".format(membership.member_id, len(host_ids)))
+                started = time.time()
+                self.update_all_containers(db, self._config, host_ids=host_ids)
+                metrics.observe('shard.sweep.duration', time.time() - started)
+        except Exception as e:
+            logging.error(e)
+            db.rollback()
+        finally:
+            db.remove()
+
+    def sweep_containers(self):
+        """
+        Run the container sweep of due hosts on its own, under a lease
+        of its own, for adaptive polling
+        """
+        db = self.get_session(self.get_engine(self._config))
+        lease = DBLease(db, 'container-sweep',
+                        ttl=get_option(self._config, 'worker', 'lease_ttl', 120),
+                        heartbeat=get_option(self._config, 'worker', 'lease_heartbeat', 30))
+        try:
+            with lease as held:
+                if not held:
+                    metrics.incr('sweep.containers.skipped')
+                    return
+                self.update_all_containers(db, self._config, lease=lease)
+        except Exception as e:
+            logging.error(e)
+            db.rollback()
+        finally:
+            db.remove()
+
+    def update_apps(self, db, refresh_hosts=None, lease=None):
+        """
+        Updates images from the registry, and deployment containers
+        and status, for every app. Given the lease guarding the sweep,
+        raises LeaseLost once it's lost.
+        """
+        apps = db.query(App).all()
+        logging.info("Fetching images for {} apps from {} ...".format(len(apps), self._registry_url))
+        app_images = self.registry().tags_for_apps([app.name for app in apps])
+        for app in apps:
+            if lease:
+                lease.check()
+            logging.info("Updating image and deployment information for {}".format(app.name))
+            try:
+                images = app_images[app.name]
+                if isinstance(images, Exception):
+                    raise images
+                self.update_app_images(db, app, images=images)
+            except Exception as e:
+                logging.error(e)
+                db.rollback()
+            
+            for deployment in app.deployments:
+                try:
+                    self.update_deployment(db, deployment, refresh_hosts=refresh_hosts)
                 except Exception as e:
                     logging.error(e)
                     db.rollback()
-                
-                for deployment in app.deployments:
-                    try:
-                        self.update_deployment(db, deployment)
-                    except Exception as e:
-                        logging.error(e)
-                        db.rollback()
-                    
+
+    def update_all(self, lease=None):
+        db = self.get_session(self.get_engine(self._config))
+        try:
+            self.update_apps(db, lease=lease)
+
+            if self._events:
+                logging.info("Container information is kept up to date by the event subscribers")
+                return
+            if self._adaptive:
+                logging.info("Container information is updated by the adaptive container sweep")
+                return
+
             logging.info("Updating container information")
             try:
-                self.update_all_containers(db, self._config)
+                self.update_all_containers(db, self._config, lease=lease)
+            except LeaseLost:
+                raise
             except Exception as e:
                 logging.error(e)
                 db.rollback()
+        except LeaseLost:
+            raise
         except Exception as e:
             logging.error(e)
             pass
+        finally:
+            db.remove()
 
-    def run_deployment(self, deployment_id):
-        thread = threading.Thread(target=self.launch_deployment, args=([deployment_id, self._config]))
+    def run_deployment(self, deployment_id, batch_size=None, max_unavailable=None):
+        thread = threading.Thread(target=self.launch_deployment, args=([deployment_id, self._config]),
+                                  kwargs={'batch_size': batch_size, 'max_unavailable': max_unavailable})
         thread.daemon = True
         thread.start()
         
-    def launch_deployment(self, deployment_id, config):
+    def launch_deployment(self, deployment_id, config, batch_size=None, max_unavailable=None):
         db = self.get_session(self.get_engine(config))
-        
+        try:
+            self._launch_deployment(db, deployment_id, config, batch_size=batch_size,
+                                    max_unavailable=max_unavailable)
+        finally:
+            db.remove()
+
+    def _record_phases(self, phases, hostname, wrapper):
+        # list.extend is atomic, so deploy threads can share phases
+        phases.extend([{'hostname': hostname, 'app_name': app_name, 'phase': phase,
+                        'duration': seconds, 'failed': failed}
+                       for app_name, phase, seconds, failed in wrapper.timings])
+
+    def _deploy_host(self, target, name, layers, config, phases):
+        """
+        Deploy the dependency layers to a single (hostname, port, alias)
+        target from a deploy thread, returning the error if the deploy failed
+        """
+        hostname, port, alias = target
+        wrapper = DockerWrapper(hostname, port, config)
+        try:
+            logging.info("Launching deployment {} on {}".format(name, alias))
+            wrapper.deploy_layers(layers, threads=get_option(config, 'deploy', 'layer_threads', 4))
+        except Exception as e:
+            logging.error("Deployment on {} failed, reason: [{}]".format(alias, e))
+            return e
+        finally:
+            self._record_phases(phases, hostname, wrapper)
+
+    def _pull_image(self, pull):
+        (hostname, port, alias), app_name, image_tag, config, phases = pull
+        wrapper = DockerWrapper(hostname, port, config)
+        try:
+            logging.info("Pulling {}:{} on {}".format(app_name, image_tag, alias))
+            wrapper.pull_image(app_name, image_tag)
+        except Exception as e:
+            logging.error("Pulling {}:{} on {} failed, reason: [{}]".format(app_name, image_tag, alias, e))
+            return e
+        finally:
+            self._record_phases(phases, hostname, wrapper)
+
+    def prepull_images(self, targets, layers, config, phases=None):
+        """
+        Pull the images of every deployment in the dependency layers
+        onto every (hostname, port, alias) target in parallel, so that
+        no running container is stopped while its image downloads.
+        Returns True if every pull succeeded.
+        """
+        phases = phases if phases is not None else []
+        pulls = [(target, d['app_name'], d['image_tag'], config, phases)
+                 for target in targets for layer in layers for d in layer]
+        if not pulls:
+            return True
+        pool = ThreadPool(min(get_option(config, 'deploy', 'pull_threads', 8), len(pulls)))
+        try:
+            errors = pool.map(self._pull_image, pulls)
+        finally:
+            pool.close()
+            pool.join()
+        return not any(errors)
+
+    def _healthy_hosts(self, db, deployment, hosts, config):
+        """
+        Refresh the containers on hosts and return the hostnames
+        where the deployment's container is running and, if the
+        deployment has a status port, answering its status endpoint
+        """
+        for host in hosts:
+            self.update_host_containers(db, host, config)
+            if self._adaptive:
+                self.reschedule_host(db, host.id, 0, reset=True)
+        self.update_deployment_containers(db, deployment, config, refresh_hosts=False)
+
+        hostnames = set([host.hostname for host in hosts])
+        running = [c for c in deployment.containers
+                   if c.state == 'running' and c.host and c.host.hostname in hostnames]
+        if not deployment.status_port:
+            return set([c.host.hostname for c in running])
+
+        status_urls = dict([(c.host.hostname, "http://%s:%s/%s" % (
+            c.host.hostname, deployment.status_port, deployment.status_endpoint)) for c in running])
+        statuses = HealthChecker.shared(config).check_all(status_urls.values())
+        return set([hostname for hostname in status_urls if statuses[status_urls[hostname]] == 'up'])
+
+    def _launch_deployment(self, db, deployment_id, config, batch_size=None, max_unavailable=None):
+        """
+        Rolling deploy across the deployment's hosts. Hosts are deployed
+        in batches of up to batch_size on a thread pool, and each batch
+        must come up healthy before the next one starts. Hosts that fail
+        to deploy or come up stay unavailable, and the deploy stops once
+        the next batch would take more than max_unavailable hosts down.
+
+        The launch is recorded as a DeploymentRun, with the duration
+        of every phase on every host.
+        """
+        batch_size = int(batch_size or get_option(config, 'deploy', 'batch_size', 1))
+        max_unavailable = int(max_unavailable or get_option(config, 'deploy', 'max_unavailable', 1))
+
         deployment = db.query(Deployment).get(deployment_id)
-        encoded = deployment.encode_with_deps(db)
-        logging.info("Launching deployment {}:{}/{}".format(deployment.app_name, deployment.image_tag, deployment.environment))
-        for host in deployment.hosts:
-            logging.info("Launching deployment {}:{}/{} on {}".format(deployment.app_name, deployment.image_tag, deployment.environment, host.alias))
-            wrapper = DockerWrapper(host.hostname, host.port, config)
-            wrapper.deploy_with_deps(encoded)
+        name = "{}:{}/{}".format(deployment.app_name, deployment.image_tag, deployment.environment)
+        run = DeploymentRun(deployment_id=deployment.id, started_at=datetime.now(), outcome='running')
+        db.add(run)
+        db.commit()
+
+        phases = []
+        outcome = 'failed'
+        try:
+            outcome = self._roll_out(db, deployment, name, config, batch_size, max_unavailable, phases)
+        finally:
+            run.finished_at = datetime.now()
+            run.outcome = outcome
+            run.phases = [DeploymentRunPhase(**phase) for phase in phases]
+            db.add(run)
+            db.commit()
+            logging.info("Finished deployment {}, outcome: {}".format(name, outcome))
 
+    def _roll_out(self, db, deployment, name, config, batch_size, max_unavailable, phases):
         try:
-            self.update_deployment_containers(db, deployment, config)
-            self.update_deployment_status(db, deployment)            
+            layers = deployment.dependency_layers(db)
+        except DependencyCycleError as e:
+            logging.error("Not launching deployment {}, dependency cycle: {}".format(name, e))
+            return 'failed'
+        hosts = list(deployment.hosts)
+        logging.info("Launching deployment {} on {} hosts, batch size {}, max unavailable {}".format(
+            name, len(hosts), batch_size, max_unavailable))
+
+        targets = [(host.hostname, host.port, host.alias) for host in hosts]
+        if not self.prepull_images(targets, layers, config, phases):
+            logging.error("Not launching deployment {}, images could not be pulled onto every host".format(name))
+            return 'failed'
+
+        unavailable = []
+        pending = list(hosts)
+        while pending:
+            budget = min(batch_size, max_unavailable - len(unavailable))
+            if budget <= 0:
+                logging.error("Stopping deployment {}, {} hosts unavailable: {}, {} hosts not deployed".format(
+                    name, len(unavailable), ', '.join(unavailable), len(pending)))
+                break
+            batch, pending = pending[:budget], pending[budget:]
+            targets = [(host.hostname, host.port, host.alias) for host in batch]
+
+            pool = ThreadPool(len(targets))
+            try:
+                errors = pool.map(lambda target: self._deploy_host(target, name, layers, config, phases), targets)
+            finally:
+                pool.close()
+                pool.join()
+
+            try:
+                healthy = self._healthy_hosts(db, deployment, batch, config)
+            except Exception as e:
+                logging.error(e)
+                db.rollback()
+                healthy = set()
+
+            for host, error in zip(batch, errors):
+                if error or host.hostname not in healthy:
+                    unavailable.append(host.alias)
+            logging.info("Deployed {} to {}, {} healthy".format(
+                name, ', '.join([host.alias for host in batch]), len(healthy)))
+
+        try:
+            self.update_deployment_status(db, deployment)
         except Exception as e:
             logging.error(e)
             db.rollback()
-        logging.info("Finished deployment {}:{}/{}".format(deployment.app_name, deployment.image_tag, deployment.environment))
+
+        if pending or unavailable:
+            return 'partial' if len(unavailable) < len(hosts) else 'failed'
+        return 'success'
@@ -7,7 +7,7 @@ setup(name='click2care-mamabear',
       version=version,
       description='Manages docker containers',
       install_requires=[
-          'cherrypy', 'apscheduler', 'routes', 'sqlalchemy', 'mysql-python',
+          'cherrypy', 'apscheduler', 'routes', 'sqlalchemy>=1.2', 'mysql-python',
           'docker-py', 'python-dateutil', 'pyopenssl', 'ndg-httpsclient',
           'pyasn1'],
       packages=find_packages(),
@@ -214,7 +214,8 @@ define([
                         params = {
                             'limit': data.length,
                             'offset': data.start,
-                            'order': data.order[0].dir
+                            'order': data.order[0].dir,
+                            'view': 'summary'
                         }
                         if (data.search && data.search.value !== '') {
                             params['app_name'] = data.search.value;
@@ -226,16 +227,6 @@ define([
                         }).done(function(json) {
                             var result = $.map(json.hits, function(row, i) {
                                 row.deployment = row.app_name+':'+row.image_tag+'/'+row.environment;
-                                row.up_containers = 0;
-                                row.host_count = 0;
-                                $.each(row.containers, function(i, container) {
-                                    if (container.status === 'up') {
-                                        row.up_containers += 1;
-                                    }
-                                });
-                                $.each(row.hosts, function(i, host) {
-                                    row.host_count += 1;
-                                });
                                 return row;
                             });
                             callback({'draw': data.draw, 'data':result, 'recordsTotal': json.total, 'recordsFiltered': json.total});
@@ -270,6 +261,8 @@ define([
                         params = {}
                         if (data.search && data.search.value !== '') {
                             params['hostname'] = data.search.value;
+                        } else {
+                            params['view'] = 'summary';
                         }
                         $.ajax({
                             type: 'GET',
@@ -277,12 +270,14 @@ define([
                             url: self.hostsPath
                         }).done(function(json) {
                             var result = $.map(json.hits, function(row, i) {
-                                row.up_containers = 0;
-                                $.each(row.containers, function(i, container) {
-                                    if (container.status === 'up') {
-                                        row.up_containers += 1;
-                                    }
-                                });
+                                if (!row.hasOwnProperty('up_containers')) {
+                                    row.up_containers = 0;
+                                    $.each(row.containers, function(i, container) {
+                                        if (container.status === 'up') {
+                                            row.up_containers += 1;
+                                        }
+                                    });
+                                }
                                 return row;
                             });
                             callback({'draw': data.draw, 'data':result, 'recordsTotal': json.total, 'recordsFiltered': json.total});
@@ -316,7 +311,7 @@ define([
                     'processing': true,
                     'serverSide': true,
                     'ajax':  function(data, callback, settings) {
-                        params = {};
+                        params = {'view': 'summary'};
                         if (data.search && data.search.value !== '') {
                             params['name'] = data.search.value;
                         }
@@ -325,25 +320,7 @@ define([
                             data: params,
                             url: self.appsPath
                         }).done(function(json) {
-                            var result = $.map(json.hits, function(row, i) {
-                                row.image_count = 0;
-                                $.each(row.images, function(i, image) {
-                                    row.image_count += 1;
-                                });
-                                
-                                row.deployment_count = 0;
-                                row.up_containers = 0;
-                                $.each(row.deployments, function(i, deployment) {
-                                    row.deployment_count += 1;
-                                    $.each(deployment.containers, function(j, container) {
-                                        if (container.status === 'up') {
-                                            row.up_containers += 1;
-                                        }
-                                    });
-                                });                                
-                                return row;
-                            });
-                            callback({'draw': data.draw, 'data':result, 'recordsTotal': json.total, 'recordsFiltered': json.total});
+                            callback({'draw': data.draw, 'data':json.hits, 'recordsTotal': json.total, 'recordsFiltered': json.total});
                         }).fail(function() {
                             console.log("Failed gettings apps");
                         })
@@ -0,0 +1,103 @@
+import unittest
+from datetime import datetime
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from mamabear.model import *
+
+class QueryCountTest(unittest.TestCase):
+    """
+    The list and get paths load everything their encoding touches
+    in a fixed number of queries, however many rows there are
+    """
+
+    def open_database(self):
+        self.engine = create_engine('sqlite://')
+        Base.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+        self.statements = []
+        event.listen(self.engine, 'before_cursor_execute', self._count)
+
+    def close_database(self):
+        self.session.close()
+        self.engine.dispose()
+
+    def _count(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    def populate(self, size):
+        now = datetime(2016, 1, 1)
+        hosts = [Host(alias='host{}'.format(i), hostname='host{}.example.com'.format(i),
+                      port=2375, status='up') for i in range(size)]
+        self.session.add_all(hosts)
+        for a in range(size):
+            app = App(name='app{}'.format(a))
+            images = [Image(id='{:04d}{:04d}'.format(a, i), tag='v{}'.format(i), app=app) for i in range(size)]
+            for i, image in enumerate(images):
+                deployment = Deployment(app=app, image_tag=image.tag, environment='prod', status_endpoint='/')
+                deployment.hosts = hosts
+                deployment.links = images[:i]
+                deployment.volumes = images[:i]
+                deployment.env_vars = [EnvironmentVariable(property_key='KEY', property_value='value')]
+                for h, host in enumerate(hosts):
+                    self.session.add(Container(
+                        id='{}-{}-{}'.format(a, i, h), host=host, image=image, deployment=deployment,
+                        status='up', state='running', started_at=now, finished_at=now))
+                self.session.add(deployment)
+            self.session.add(app)
+        self.session.commit()
+        self.session.expunge_all()
+
+    def queries(self, fn):
+        del self.statements[:]
+        fn()
+        count = len(self.statements)
+        self.session.expunge_all()
+        return count
+
+    def assertQueries(self, expected, fn):
+        for size in (1, 4):
+            self.open_database()
+            try:
+                self.populate(size)
+                self.assertEqual(self.queries(fn), expected, "{} rows: {}".format(size, self.statements))
+            finally:
+                self.close_database()
+
+    def test_list_hosts(self):
+        self.assertQueries(2, lambda: Host.list(self.session))
+
+    def test_get_host(self):
+        self.assertQueries(3, lambda: Host.get_by_name(self.session, 'host0.example.com', eager=True).encode())
+
+    def test_list_apps(self):
+        self.assertQueries(8, lambda: App.list(self.session))
+
+    def test_get_app(self):
+        self.assertQueries(8, lambda: App.get(self.session, 'app0', eager=True).encode())
+
+    def test_list_deployments(self):
+        self.assertQueries(6, lambda: Deployment.list(self.session, limit=100))
+
+    def test_list_deployments_page(self):
+        self.assertQueries(6, lambda: Deployment.list_page(self.session, limit=100))
+
+    def test_get_deployment(self):
+        self.assertQueries(7, lambda: Deployment.get_by_app(
+            self.session, 'app0', image_tag='v0', environment='prod', eager=True).encode())
+
+    def test_list_containers(self):
+        self.assertQueries(1, lambda: Container.list(self.session, limit=100))
+
+    def test_get_container(self):
+        self.assertQueries(1, lambda: Container.get(self.session, '0-0-0', eager=True).encode())
+
+    def test_list_images(self):
+        self.assertQueries(1, lambda: Image.list(self.session, limit=100))
+
+    def test_summary_views(self):
+        self.assertQueries(3, lambda: Host.list(self.session, view='summary'))
+        self.assertQueries(4, lambda: App.list(self.session, view='summary'))
+        self.assertQueries(3, lambda: Deployment.list(self.session, view='summary', limit=100))
+
+if __name__ == '__main__':
+    unittest.main()